@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Builds a synthetic course with eely and reports how long each stage takes.
+# marp is replaced by the stub under test/ so that everything runs offline.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from pathlib import Path
+from fpdf import FPDF
+
+EELY = Path(__file__).resolve().parent.parent / "eely.py"
+STUB_MARP = Path(__file__).resolve().parent.parent / "test" / "stub-marp-cli.py"
+
+# The phases eely records with --trace-json that are reported as stages
+STAGES = [
+    "plan_filetree",
+    "render_lectures",
+    "merge_course_slides",
+    "stream_course_slides",
+    "linearize_pdf",
+    "create_toc",
+    "deduplicate_objects",
+    "add_watermark_xobject",
+    "stamp_pages",
+    # Only recorded with --watermark-lectures
+    "add_watermark",
+    "zip_labs_material",
+    "zip_course_material",
+    "write_archive",
+    "build_search_index",
+    "generate_index_page",
+]
+MODES = ["link", "html", "pdf"]
+
+# Stages faster than this are too noisy to flag as regressions
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chapters", type=int, default=10, help="Number of chapters")
+    parser.add_argument(
+        "--lectures", type=int, default=10, help="Number of lectures per chapter"
+    )
+    parser.add_argument(
+        "--slides", type=int, default=20, help="Number of slides (pages) per lecture"
+    )
+    parser.add_argument(
+        "--extras-mb", type=float, default=10, help="Total size of the extras in MB"
+    )
+    parser.add_argument(
+        "--watermark", action="store_true", help="Watermark the course slides"
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=MODES,
+        default=MODES,
+        help="The eely modes to benchmark",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs per mode, the fastest one is reported",
+    )
+    parser.add_argument(
+        "--eely-args",
+        default="",
+        help="Extra arguments for eely, e.g. '--jobs 4 --batch chapter'",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="Fail if slower than the results in this JSON file"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown per stage when comparing, e.g. 0.2 for 20%%",
+    )
+    args = parser.parse_args()
+
+    parameters = {
+        "chapters": args.chapters,
+        "lectures": args.lectures,
+        "slides": args.slides,
+        "extras_mb": args.extras_mb,
+        "watermark": args.watermark,
+        "eely_args": args.eely_args,
+    }
+    with tempfile.TemporaryDirectory() as course_dir:
+        config_path = generate_course(Path(course_dir), **parameters)
+        results = {
+            mode: benchmark_mode(config_path, mode, args.eely_args.split(), args.repeat)
+            for mode in args.modes
+        }
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"parameters": parameters, "results": results}, output_file)
+
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["parameters"] != parameters:
+            print("Warning: the baseline was measured with different parameters")
+        regressions = find_regressions(baseline["results"], results, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+def generate_course(
+    course_dir, chapters, lectures, slides, extras_mb, watermark, **_
+) -> Path:
+    config = {
+        "title": "Benchmark course",
+        "root": "lectures",
+        "output": "output",
+        "marp-cli": str(STUB_MARP),
+        "chapters": {},
+    }
+    extras_size_per_chapter = int(extras_mb * 1024 * 1024 / max(1, chapters))
+    for chapter_number in range(chapters):
+        chapter_root = Path(course_dir, "lectures", f"chapter-{chapter_number:03}")
+        Path(chapter_root, "resources").mkdir(parents=True)
+        chapter = {
+            "root": chapter_root.name,
+            "assets": "resources",
+            "lectures": {},
+            "extras": [],
+        }
+        for lecture_number in range(lectures):
+            lecture = Path(chapter_root, f"lecture-{lecture_number:03}.md")
+            lecture.write_text(
+                "\n---\n".join(
+                    f"# Lecture {lecture_number} slide {slide}\n\n"
+                    + "Some text on the slide\n" * 10
+                    for slide in range(slides)
+                )
+            )
+            chapter["lectures"][f"Lecture {lecture_number}"] = lecture.name
+
+        if extras_size_per_chapter:
+            exercises = Path(chapter_root, "exercises")
+            exercises.mkdir()
+            # Half of the extras compress well, the other half not at all
+            Path(exercises, "exercise.txt").write_bytes(
+                b"int main() { return 0; }\n" * (extras_size_per_chapter // 2 // 25 + 1)
+            )
+            Path(exercises, "dataset.bin").write_bytes(
+                os.urandom(extras_size_per_chapter // 2)
+            )
+            chapter["extras"].append("exercises")
+        config["chapters"][f"Chapter {chapter_number}"] = chapter
+
+    if watermark:
+        watermark_pdf = FPDF(orientation="L", unit="pt", format=(720, 1280))
+        watermark_pdf.add_page()
+        watermark_pdf.set_font("Helvetica", size=40)
+        watermark_pdf.text(100, 100, "Benchmark watermark")
+        watermark_pdf.output(Path(course_dir, "watermark.pdf"))
+        config["watermark"] = "watermark.pdf"
+
+    config_path = Path(course_dir, "benchmark.yaml")
+    with open(config_path, "w") as config_file:
+        yaml.safe_dump(config, config_file)
+    return config_path
+
+
+def benchmark_mode(config_path, mode, eely_args, repeat):
+    runs = []
+    for _ in range(max(1, repeat)):
+        trace_path = Path(config_path.parent, "trace.json")
+        start = time.perf_counter()
+        subprocess.check_call(
+            [
+                sys.executable,
+                EELY,
+                f"--{mode}",
+                config_path,
+                "--no-cache",
+                "--trace-json",
+                trace_path,
+                *eely_args,
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        run = {"total": time.perf_counter() - start}
+        with open(trace_path, "r") as trace_file:
+            for event in json.load(trace_file)["traceEvents"]:
+                if event["name"] in STAGES:
+                    run[event["name"]] = run.get(event["name"], 0) + event["dur"] / 1e6
+        runs.append(run)
+
+    return {
+        stage: min(run.get(stage, 0) for run in runs)
+        for stage in ["total"] + STAGES
+        if any(stage in run for run in runs)
+    }
+
+
+def print_results(results):
+    for mode, stages in results.items():
+        print(f"--{mode}")
+        for stage, seconds in stages.items():
+            print(f"  {seconds:9.3f} s  {stage}")
+
+
+def find_regressions(baseline, results, threshold):
+    regressions = []
+    for mode, stages in results.items():
+        for stage, seconds in stages.items():
+            baseline_seconds = baseline.get(mode, {}).get(stage)
+            if baseline_seconds is None or seconds < REGRESSION_MIN_SECONDS:
+                continue
+            if seconds > baseline_seconds * (1 + threshold):
+                regressions.append(
+                    f"--{mode} {stage} took {seconds:.3f} s "
+                    + f"instead of {baseline_seconds:.3f} s"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    sys.exit(main())
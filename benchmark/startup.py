@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Measures how long eely takes to start and to run --link on a synthetic course,
+# e.g. to compare the current eely.py with an older one:
+#   git show HEAD~1:eely.py > /tmp/eely-before.py
+#   python3 benchmark/startup.py --eely /tmp/eely-before.py eely.py
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from benchmark import EELY, generate_course
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--eely",
+        nargs="+",
+        default=[EELY],
+        help="The eely.py scripts to measure (default: the one of this repository)",
+    )
+    parser.add_argument("--chapters", type=int, default=10, help="Number of chapters")
+    parser.add_argument(
+        "--lectures", type=int, default=20, help="Number of lectures per chapter"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="Number of runs of each command, the fastest one is reported",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as course_dir:
+        config_path = generate_course(
+            Path(course_dir),
+            chapters=args.chapters,
+            lectures=args.lectures,
+            slides=1,
+            extras_mb=0,
+            watermark=False,
+        )
+        print(f"{args.chapters * args.lectures} lectures")
+        for eely in args.eely:
+            print(eely)
+            for run, seconds in benchmark_startup(eely, config_path, args.repeat):
+                print(f"  {seconds:9.3f} s  {run}")
+
+
+def benchmark_startup(eely, config_path, repeat):
+    commands = {
+        "interpreter": [sys.executable, "-c", "pass"],
+        # Runs the imports and definitions of eely, but not main()
+        "import": [
+            sys.executable,
+            "-c",
+            f"import runpy; runpy.run_path({str(eely)!r})",
+        ],
+        "--help": [sys.executable, eely, "--help"],
+        "--link": [sys.executable, eely, "--link", config_path],
+    }
+    # Older versions of eely, e.g. to compare with, have no --no-cache
+    usage = subprocess.run(
+        commands["--help"], stdout=subprocess.PIPE, text=True, check=True
+    ).stdout
+    if "--no-cache" in usage:
+        commands["--link --no-cache"] = [*commands["--link"], "--no-cache"]
+    # The first --link creates the filetree, later ones find it in place
+    subprocess.check_call(commands["--link"], stdout=subprocess.DEVNULL)
+    results = []
+    for name, command in commands.items():
+        runs = []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            subprocess.check_call(command, stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+        results.append((name, min(runs)))
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import struct
 import sys
+import threading
+import time
+import urllib.parse
 import yaml
 import subprocess
 import tempfile
+import zlib
 
 from yattag import Doc, indent
 from pathlib import Path
-from pypdf import PdfWriter, PdfReader, Transformation
-from pypdf.generic import AnnotationBuilder
-from fpdf import FPDF
-from zipfile import ZipFile
+from contextlib import contextmanager, nullcontext
+from collections import deque
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+# The PDF and archive backends take longer to import than --link takes to run, so
+# pypdf, fpdf and zipfile are imported by the functions that use them
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 INDEX_DEFAULT_CSS = """
     ol {
@@ -35,8 +64,221 @@ INDEX_DEFAULT_CSS = """
     body {
         background: linear-gradient(to right, #d7d2cc 0%, #304352 100%);
     }
+
+    #search {
+        font-size: 24pt;
+    }
 """
 
+# Searches the index loaded from SEARCH_INDEX_NAME, where every term maps to a
+# flat list of the lectures and slides it appears on
+INDEX_SEARCH_SCRIPT = r"""
+function search(query) {
+    const index = window.EELY_SEARCH_INDEX;
+    const results = document.getElementById("search-results");
+    results.replaceChildren();
+    const words = query.toLowerCase().match(/[\p{L}\p{N}]{2,}/gu);
+    if (!index || !words) return;
+    let matches = null;
+    for (const word of words) {
+        const slides = new Set();
+        for (const [term, postings] of Object.entries(index.terms)) {
+            if (!term.startsWith(word)) continue;
+            for (let i = 0; i < postings.length; i += 2) {
+                slides.add(postings[i] + ":" + postings[i + 1]);
+            }
+        }
+        matches = matches === null ? slides : new Set([...matches].filter((slide) => slides.has(slide)));
+    }
+    const sorted = [...matches].map((match) => match.split(":").map(Number));
+    sorted.sort((a, b) => a[0] - b[0] || a[1] - b[1]);
+    for (const [lecture, slide] of sorted.slice(0, 50)) {
+        const [chapterTitle, lectureTitle, href, firstPage] = index.lectures[lecture];
+        const link = document.createElement("a");
+        link.href = href + (href.endsWith(".html") ? `#${slide}` : href.endsWith(".pdf") ? `#page=${slide}` : "");
+        link.textContent = `${chapterTitle}: ${lectureTitle}, slide ${slide}`;
+        const item = document.createElement("li");
+        item.append(link);
+        if (index.course_slides && firstPage !== null) {
+            const page = firstPage + slide - 1;
+            const pageLink = document.createElement("a");
+            pageLink.href = `${index.course_slides}#page=${page}`;
+            pageLink.textContent = `page ${page}`;
+            item.append(" (", pageLink, ")");
+        }
+        results.append(item);
+    }
+}
+"""
+
+# Add both html and pdf arguments to render HTML tags for PDF
+MARP_OUTPUT_FLAGS = {"html": ["--html"], "pdf": ["--html", "--pdf"]}
+
+RENDER_CACHE_DEFAULT_DIR = Path(
+    os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"), "eely"
+)
+RENDER_CACHE_DEFAULT_SIZE_MB = 2048
+
+WATCH_POLL_SECONDS = 0.5
+
+SERVE_DEFAULT_PORT = 8000
+
+MANIFEST_NAME = ".eely-manifest.json"
+MANIFEST_VERSION = 2
+
+# A script rather than JSON, since pages opened from disk may not fetch files
+SEARCH_INDEX_NAME = "search-index.js"
+SEARCH_CACHE_NAME = ".eely-search-cache.json"
+SEARCH_CACHE_VERSION = 2
+
+WATERMARK_XOBJECT_NAME = "/EelyWatermark"
+
+SHARED_OBJECTS_EXCLUDED_TYPES = ["/Page", "/Pages", "/Catalog", "/Outlines", "/Annot"]
+
+ARCHIVE_COMPRESSION_METHODS = {
+    "stored": "ZIP_STORED",
+    "deflated": "ZIP_DEFLATED",
+    "bzip2": "ZIP_BZIP2",
+    "lzma": "ZIP_LZMA",
+}
+ARCHIVE_DEFAULT_COMPRESSION = "stored"
+# Compressing these again only costs time
+ARCHIVE_DEFAULT_STORED_SUFFIXES = [
+    ".7z",
+    ".bz2",
+    ".gif",
+    ".gz",
+    ".jpeg",
+    ".jpg",
+    ".mp3",
+    ".mp4",
+    ".pdf",
+    ".png",
+    ".xz",
+    ".zip",
+]
+ARCHIVE_COPY_CHUNK_SIZE = 1024 * 1024
+# How to tell that an entry of the previous archive can be reused as it is. Zip
+# timestamps have a resolution of two seconds, so with mtime a file edited to the
+# same size within two seconds is taken as unchanged
+ARCHIVE_REUSE_CHECKS = ["crc", "mtime", "never"]
+ARCHIVE_DEFAULT_REUSE = "crc"
+
+PROFILE_SLOWEST_LECTURES = 10
+
+# Set by --profile or --trace-json to record how long each phase of the build takes
+BUILD_PROFILE = None
+
+RENDER_NODE_CONNECT_SECONDS = 10
+RENDER_NODE_RENDER_SECONDS = 600
+RENDER_NODE_ATTEMPTS = 3
+RENDER_NODE_CHUNK_SIZE = 1024 * 1024
+# Output flags a render node passes on to marp, anything else is refused
+RENDER_NODE_FLAGS = ["--html", "--pdf"]
+# Set by --render-nodes to send the renders to other machines
+RENDER_NODES = None
+
+TOC_TITLE_FONT_SIZE = 40
+TOC_CHAPTER_FONT_SIZE = 14
+TOC_SLIDE_FONT_SIZE = 12
+
+
+class BuildProfile:
+    """Wall time and peak memory of the phases of a build"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, category, details):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "category": category,
+                "start": start - self.start,
+                "duration": time.perf_counter() - start,
+                "thread": threading.get_ident(),
+                "peak_rss": get_peak_rss(),
+                "details": details,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        phases = [e for e in self.events if e["category"] != "lecture"]
+        lectures = [e for e in self.events if e["category"] == "lecture"]
+        lines = ["Build profile (wall time, peak RSS):"]
+        for event in sorted(phases, key=lambda e: e["duration"], reverse=True):
+            lines.append(format_profile_event(event))
+        if lectures:
+            lines.append("Slowest lecture renders:")
+            lectures.sort(key=lambda e: e["duration"], reverse=True)
+            for event in lectures[:PROFILE_SLOWEST_LECTURES]:
+                lines.append(format_profile_event(event))
+            if len(lectures) > PROFILE_SLOWEST_LECTURES:
+                lines.append(
+                    f"  ...and {len(lectures) - PROFILE_SLOWEST_LECTURES} more"
+                )
+        return "\n".join(lines)
+
+    def write_trace(self, trace_path):
+        # See the "Trace Event Format" for the details of the format
+        trace_events = [
+            {
+                "name": event["name"],
+                "cat": event["category"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": event["thread"],
+                "args": {**event["details"], "peak_rss": event["peak_rss"]},
+            }
+            for event in self.events
+        ]
+        with open(trace_path, "w") as trace_file:
+            json.dump(
+                {"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file
+            )
+
+
+def format_profile_event(event):
+    peak_rss = "" if event["peak_rss"] is None else f'{event["peak_rss"] >> 20} MB'
+    return f'  {event["duration"]:9.3f} s {peak_rss:>9}  {event["name"]}'
+
+
+def get_peak_rss():
+    # Includes the marp processes, which usually need more memory than eely itself
+    if resource is None:
+        return None
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def profile_phase(name, category="phase", **details):
+    if BUILD_PROFILE is None:
+        return nullcontext()
+    return BUILD_PROFILE.phase(name, category, details)
+
+
+def profiled(function):
+    @functools.wraps(function)
+    def profiled_function(*args, **kwargs):
+        if BUILD_PROFILE is None:
+            return function(*args, **kwargs)
+        with BUILD_PROFILE.phase(function.__name__, "phase", {}):
+            return function(*args, **kwargs)
+
+    return profiled_function
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -71,71 +313,186 @@ def main():
         help="Set or override the watermark property of config",
         required=False,
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of lectures to render in parallel (default: number of CPUs)",
+        required=False,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Render every lecture even if an identical render is cached and "
+        + "recompress every entry of the archives",
+        required=False,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=f"Directory of the render cache (default: {RENDER_CACHE_DEFAULT_DIR})",
+        default=RENDER_CACHE_DEFAULT_DIR,
+        required=False,
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=RENDER_CACHE_DEFAULT_SIZE_MB,
+        help="Maximum size of the render cache in MB, least recently used "
+        + f"renders are evicted first (default: {RENDER_CACHE_DEFAULT_SIZE_MB})",
+        required=False,
+    )
+    parser.add_argument(
+        "--batch",
+        choices=["chapter", "course"],
+        help="Render all lectures of a chapter or of the whole course with a single "
+        + "marp invocation instead of one invocation per lecture",
+        required=False,
+    )
+    parser.add_argument(
+        "--watermark-lectures",
+        action="store_true",
+        help="Apply the watermark to each lecture PDF as soon as it is rendered "
+        + "instead of to the complete course slides",
+        required=False,
+    )
+    parser.add_argument(
+        "--render-nodes",
+        nargs="+",
+        metavar="ADDRESS",
+        help="Send the lectures to render to these render nodes, e.g. "
+        + "build-1:9000 build-2:9000, instead of rendering them locally",
+        required=False,
+    )
+    parser.add_argument(
+        "--marp-cli",
+        default="marp",
+        help="The marp executable of a render node (default: marp)",
+        required=False,
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Write the course slides one lecture at a time, so that the memory "
+        + "needed does not grow with the size of the course",
+        required=False,
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and rebuild the outputs affected by changes to the "
+        + "configuration, lectures, assets, extras or watermark",
+        required=False,
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=SERVE_DEFAULT_PORT,
+        help=f"Port to serve the course on with --serve (default: {SERVE_DEFAULT_PORT})",
+        required=False,
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Validate the configuration and print the build steps without running them",
+        required=False,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in each phase of the build and the slowest lectures",
+        required=False,
+    )
+    parser.add_argument(
+        "--trace-json",
+        metavar="TRACE",
+        help="Write the phases of the build as a Chrome trace (chrome://tracing)",
+        required=False,
+    )
     group.add_argument(
         "--link",
         metavar="CONFIG",
+        nargs="+",
         help="Create links to slides in a directory structure for delivery",
     )
     group.add_argument(
         "--html",
         metavar="CONFIG",
+        nargs="+",
         help="Create HTML pages for slides in a directory structure for delivery",
     )
     group.add_argument(
         "--pdf",
         metavar="CONFIG",
+        nargs="+",
         help="Create PDFs for slides in a directory structure for delivery",
     )
+    group.add_argument(
+        "--serve",
+        metavar="CONFIG",
+        nargs="+",
+        help="Serve the course on localhost, rendering each lecture to HTML (or PDF "
+        + "when its .pdf is requested) the first time it is opened",
+    )
+    group.add_argument(
+        "--render-node",
+        metavar="ADDRESS",
+        help="Run as a render node listening on ADDRESS, e.g. 0.0.0.0:9000, that "
+        + "renders the lectures sent by --render-nodes",
+    )
     args = parser.parse_args()
 
+    if args.render_node:
+        serve_render_node(parse_address(args.render_node), args)
+        return
+
     if args.link:
         package_material = False
-        config_path = Path(args.link)
+        config_args = args.link
         output_format = "md"
         action = create_links
     elif args.html:
         package_material = False
-        config_path = Path(args.html)
+        config_args = args.html
         output_format = "html"
         action = create_html
     elif args.pdf:
         package_material = True
-        config_path = Path(args.pdf)
+        config_args = args.pdf
         output_format = "pdf"
         action = create_pdf
+    elif args.serve:
+        package_material = False
+        config_args = args.serve
+        output_format = "html"
+        action = create_html
     else:
         raise RuntimeError("Action missing, we should not get here")
 
-    config_path = config_path.resolve()
-    with open(config_path, "r") as config_file:
-        config = yaml.safe_load(config_file)
-
-    override_config(config, args)
-
-    config_dir = config_path.parent
-    table_of_contents, output_dir, extra_paths = create_filetree(
-        config, config_dir, output_format, action
-    )
-    course_slides = None
-    labs_archive = None
-    course_archive = None
-    if package_material:
-        course_slides = merge_course_slides(config, table_of_contents, output_dir)
-        if "watermark" in config:
-            watermark_path = Path(config["watermark"])
-            watermark_path = (
-                watermark_path
-                if watermark_path.is_absolute()
-                else Path(config_dir, watermark_path)
-            )
-            add_watermark(course_slides, watermark_path)
-        course_archive = zip_course_material(
-            config, output_dir, extra_paths, course_slides
+    # Directories stand for all the configuration files in them
+    config_paths = []
+    for config_arg in map(Path, config_args):
+        if config_arg.is_dir():
+            config_paths += sorted(config_arg.glob("*.yaml"))
+            config_paths += sorted(config_arg.glob("*.yml"))
+        else:
+            config_paths.append(config_arg)
+    config_paths = [config_path.resolve() for config_path in config_paths]
+    if not config_paths:
+        parser.error(f"No configuration files found in: {' '.join(config_args)}")
+    if args.watch and len(config_paths) > 1:
+        parser.error("Only a single configuration file can be watched")
+    if args.watch and args.dry_run:
+        parser.error("A dry run cannot be watched")
+    if args.serve and len(config_paths) > 1:
+        parser.error("Only a single configuration file can be served")
+    if args.serve and (args.watch or args.dry_run):
+        parser.error("Serving renders on demand, it cannot be watched or a dry run")
+    if args.render_nodes and args.batch:
+        parser.error(
+            "Batches are rendered locally, they cannot be sent to render nodes"
         )
-        labs_archive = Path(
-            course_archive.parent, course_archive.stem + "-labs" + course_archive.suffix
-        )
-        delete_from_archive(course_archive, course_slides.name, labs_archive)
+    if (args.config_title or args.config_output) and len(config_paths) > 1:
+        parser.error("The title and output of multiple deliveries cannot be the same")
 
     if args.css:
         with open(args.css, "r") as css_file:
@@ -143,19 +500,796 @@ def main():
     else:
         index_css = INDEX_DEFAULT_CSS
 
+    global BUILD_PROFILE
+    if args.profile or args.trace_json:
+        BUILD_PROFILE = BuildProfile()
+    global RENDER_NODES
+    if args.render_nodes:
+        RENDER_NODES = RenderNodePool(map(parse_address, args.render_nodes))
+
+    try:
+        if args.serve:
+            serve_delivery(config_paths[0], args, index_css)
+        elif args.watch:
+            watch_delivery(
+                config_paths[0],
+                args,
+                output_format,
+                action,
+                package_material,
+                index_css,
+            )
+        elif len(config_paths) == 1:
+            build_delivery(
+                config_paths[0],
+                args,
+                output_format,
+                action,
+                package_material,
+                index_css,
+            )
+        else:
+            build_deliveries(
+                config_paths, args, output_format, action, package_material, index_css
+            )
+    finally:
+        if args.profile:
+            print(BUILD_PROFILE.summary())
+        if args.trace_json:
+            BUILD_PROFILE.write_trace(args.trace_json)
+
+
+def build_delivery(
+    config_path, args, output_format, action, package_material, index_css
+):
+    return build_deliveries(
+        [config_path], args, output_format, action, package_material, index_css
+    )[0]
+
+
+def build_deliveries(
+    config_paths, args, output_format, action, package_material, index_css
+):
+    deliveries = [
+        plan_delivery(config_path, args, output_format) for config_path in config_paths
+    ]
+    names = [delivery["name"] for delivery in deliveries]
+    if len(set(names)) < len(names):
+        for delivery, config_path in zip(deliveries, config_paths):
+            delivery["name"] = str(config_path)
+    for delivery in deliveries:
+        plan_manifest(delivery, args, output_format)
+
+    # Lectures shared between deliveries are rendered once and copied to the rest
+    rendered_lectures = {}
+    lectures_to_copy = []
+    for delivery in deliveries:
+        lectures_to_render = []
+        for lecture in delivery["lectures"]:
+            lecture_src, lecture_dest, assets_dir = lecture
+            render_options = (
+                lecture_src.resolve(),
+                None if assets_dir is None else assets_dir.resolve(),
+                lecture_dest.suffix,
+                marp_executable(delivery["config"]),
+                (
+                    get_watermark_path(delivery["config"], delivery["config_dir"])
+                    if args.watermark_lectures
+                    else None
+                ),
+            )
+            if lecture_dest in delivery["unchanged_lectures"]:
+                if output_format in MARP_OUTPUT_FLAGS:
+                    rendered_lectures.setdefault(render_options, lecture_dest)
+            elif output_format not in MARP_OUTPUT_FLAGS:
+                lectures_to_render.append(lecture)
+            elif render_options in rendered_lectures:
+                lectures_to_copy.append(
+                    (rendered_lectures[render_options], lecture_dest)
+                )
+            else:
+                rendered_lectures[render_options] = lecture_dest
+                lectures_to_render.append(lecture)
+        delivery["lectures_to_render"] = lectures_to_render
+
+    build_plan = plan_build(
+        deliveries,
+        lectures_to_copy,
+        args,
+        output_format,
+        action,
+        package_material,
+        index_css,
+    )
+    if args.dry_run:
+        print(build_plan.describe())
+        return deliveries
+    build_plan.run()
+
+    if len(deliveries) > 1:
+        rendered = sum(len(delivery["lectures_to_render"]) for delivery in deliveries)
+        print(f"Rendered {rendered} unique lectures for {len(deliveries)} deliveries")
+    for delivery in deliveries:
+        write_manifest(delivery["output_dir"], delivery["manifest"])
+        render_cache = delivery["render_cache"]
+        if render_cache:
+            render_cache.evict()
+            print(
+                f"Render cache: {render_cache.hits} hits, {render_cache.misses} misses"
+            )
+
+    return deliveries
+
+
+def plan_build(
+    deliveries,
+    lectures_to_copy,
+    args,
+    output_format,
+    action,
+    package_material,
+    index_css,
+):
+    # Only what depends on the rendered lectures waits for them, e.g. the extras
+    # are archived while the lectures are still rendering. The lectures of all the
+    # deliveries are rendered by a single step, so that at most --jobs renders run
+    build_plan = TaskGraph()
+    lectures_to_render = sum(
+        len(delivery["lectures_to_render"]) for delivery in deliveries
+    )
+    rendered = [
+        build_plan.add(
+            f"Render {lectures_to_render} lectures of "
+            + (
+                deliveries[0]["name"]
+                if len(deliveries) == 1
+                else f"{len(deliveries)} deliveries"
+            ),
+            functools.partial(
+                render_delivery_lectures,
+                [(delivery, delivery["lectures_to_render"]) for delivery in deliveries],
+                args,
+                output_format,
+                action,
+            ),
+        )
+    ]
+    if lectures_to_copy:
+        rendered = [
+            build_plan.add(
+                f"Copy {len(lectures_to_copy)} lectures shared between deliveries",
+                functools.partial(copy_lectures, lectures_to_copy),
+                rendered,
+            )
+        ]
+
+    for delivery in deliveries:
+        config = delivery["config"]
+        output_dir = delivery["output_dir"]
+        course_slides = None
+        course_archive = None
+        labs_archive = None
+        index_dependencies = rendered
+        if package_material:
+            course_slides = get_course_slides_path(config, output_dir)
+            course_archive, labs_archive = get_archive_paths(config, output_dir)
+            delivery["course_slides"] = course_slides
+            labs = build_plan.add(
+                f'Archive the extras of {delivery["name"]}',
+                functools.partial(
+                    zip_labs_material,
+                    config,
+                    output_dir,
+                    delivery["extra_paths"],
+                    args.jobs,
+                    not args.no_cache,
+                ),
+            )
+            slides = build_plan.add(
+                f'Merge the course slides of {delivery["name"]}',
+                functools.partial(
+                    build_course_slides,
+                    config,
+                    delivery["config_dir"],
+                    delivery["table_of_contents"],
+                    output_dir,
+                    args.watermark_lectures,
+                    args.low_memory,
+                ),
+                rendered,
+            )
+            index_dependencies = [
+                build_plan.add(
+                    f'Archive the course of {delivery["name"]}',
+                    functools.partial(
+                        zip_course_material, config, output_dir, course_slides
+                    ),
+                    [labs, slides],
+                )
+            ]
+        # The index only needs the Markdown, and the course slides for their pages
+        index_dependencies = [
+            *index_dependencies,
+            build_plan.add(
+                f'Build the search index of {delivery["name"]}',
+                functools.partial(
+                    build_search_index,
+                    delivery["table_of_contents"],
+                    delivery["lectures"],
+                    output_dir,
+                    course_slides,
+                ),
+                [slides] if package_material else [],
+            ),
+        ]
+        build_plan.add(
+            f'Generate the index page of {delivery["name"]}',
+            functools.partial(
+                generate_index_page,
+                delivery["table_of_contents"],
+                index_css,
+                course_slides,
+                course_archive,
+                labs_archive,
+                output_dir,
+                config,
+                package_material,
+            ),
+            index_dependencies,
+        )
+
+    return build_plan
+
+
+def copy_lectures(lectures_to_copy):
+    for rendered_lecture, lecture_dest in lectures_to_copy:
+        shutil.copyfile(rendered_lecture, lecture_dest)
+
+
+class TaskGraph:
+    """Build steps that run concurrently as soon as their dependencies are done"""
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, function, dependencies=()):
+        assert name not in self.tasks, f"Duplicate build step: {name}"
+        for dependency in dependencies:
+            assert dependency in self.tasks, f"Unknown build step: {dependency}"
+        self.tasks[name] = (function, list(dependencies))
+        return name
+
+    def describe(self):
+        steps = []
+        for number, (name, (_, dependencies)) in enumerate(self.tasks.items(), 1):
+            steps.append(f"{number}. {name}")
+            steps += [f"   after: {dependency}" for dependency in dependencies]
+        return "\n".join(steps)
+
+    def run(self):
+        # The steps spread their own work over --jobs threads, so every step that
+        # is ready starts right away
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            while len(done) < len(self.tasks):
+                for name, (function, dependencies) in self.tasks.items():
+                    if name in done or name in running.values():
+                        continue
+                    if all(dependency in done for dependency in dependencies):
+                        running[executor.submit(function)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise RuntimeError(f"Failed to {name.lower()}") from e
+                    done.add(name)
+
+
+def plan_delivery(config_path, args, output_format):
+    config = load_config(config_path, args)
+    config_dir = config_path.parent
+
+    watermark_path = get_watermark_path(config, config_dir)
+    assert (
+        watermark_path is None or watermark_path.is_file()
+    ), f"Watermark {watermark_path} does not exist"
+    if output_format in MARP_OUTPUT_FLAGS and not RENDER_NODES:
+        marp = marp_executable(config)
+        assert shutil.which(marp), f"marp executable {marp} not found"
+    if output_format == "pdf" and config.get("linearize", False):
+        assert shutil.which("qpdf"), "qpdf is needed to linearize the course slides"
+
+    render_cache = None
+    if output_format in MARP_OUTPUT_FLAGS and not args.no_cache and not args.dry_run:
+        render_cache = RenderCache(
+            args.cache_dir,
+            args.cache_size * 1024 * 1024,
+            marp_executable(config),
+            MARP_OUTPUT_FLAGS[output_format],
+        )
+
+    table_of_contents, output_dir, extra_paths, lectures, asset_links = plan_filetree(
+        config, config_dir, output_format, args.dry_run
+    )
+
+    return {
+        "name": config_path.name,
+        "config": config,
+        "config_dir": config_dir,
+        "table_of_contents": table_of_contents,
+        "output_dir": output_dir,
+        "extra_paths": extra_paths,
+        "lectures": lectures,
+        "asset_links": asset_links,
+        "render_cache": render_cache,
+        "course_slides": None,
+    }
+
+
+def plan_manifest(delivery, args, output_format):
+    # Compares the outputs of this build with the manifest of the previous one, so
+    # that lectures whose inputs did not change are skipped and outputs that are
+    # no longer part of the delivery are deleted. Every output format has its own
+    # outputs, so that building e.g. the HTML keeps the PDFs and archives
+    config = delivery["config"]
+    output_dir = delivery["output_dir"]
+    manifest = load_manifest(output_dir)
+    previous_outputs = manifest.get(output_format, {})
+    outputs = {}
+    unchanged_lectures = set()
+    assets_signatures = {}
+    watermark_path = get_watermark_path(config, delivery["config_dir"])
+    watermark_signature = (
+        get_file_signature(watermark_path)
+        if args.watermark_lectures and watermark_path
+        else None
+    )
+    new = changed = 0
+    for lecture_src, lecture_dest, assets_dir in delivery["lectures"]:
+        # Links only depend on where the lecture is
+        signature = [str(lecture_src)]
+        if output_format in MARP_OUTPUT_FLAGS:
+            if assets_dir is not None and assets_dir not in assets_signatures:
+                assets_signatures[assets_dir] = get_directory_signature(assets_dir)
+            signature += [
+                get_file_signature(lecture_src),
+                assets_signatures.get(assets_dir),
+                str(marp_executable(config)),
+                watermark_signature,
+            ]
+        output = lecture_dest.relative_to(output_dir).as_posix()
+        outputs[output] = signature
+        if output not in previous_outputs:
+            new += 1
+        elif previous_outputs[output] != signature or not lecture_dest.exists():
+            changed += 1
+        elif not args.no_cache:
+            unchanged_lectures.add(lecture_dest)
+
+    # The rest of the outputs are always created, but are recorded so that they
+    # are deleted once they are no longer created, e.g. when the title changes
+    other_outputs = [
+        *delivery["asset_links"],
+        Path(output_dir, "index.html"),
+        Path(output_dir, SEARCH_INDEX_NAME),
+    ]
+    if output_format == "pdf":
+        other_outputs.append(get_course_slides_path(config, output_dir))
+        other_outputs += get_archive_paths(config, output_dir)
+    for other_output in other_outputs:
+        if other_output.is_relative_to(output_dir):
+            outputs[other_output.relative_to(output_dir).as_posix()] = None
+
+    other_formats_outputs = {
+        output
+        for other_format, other_outputs in manifest.items()
+        if other_format != output_format
+        for output in other_outputs
+    }
+    orphans = [
+        output
+        for output in previous_outputs
+        if output not in outputs and output not in other_formats_outputs
+    ]
+    if not args.dry_run:
+        output_dirs = {
+            directory
+            for output in [*outputs, *other_formats_outputs]
+            for directory in Path(output).parents
+        }
+        for orphan in orphans:
+            remove_output(output_dir, orphan, output_dirs)
+    print(
+        f'{delivery["name"]}: {new} new, {changed} changed, '
+        + f"{len(unchanged_lectures)} unchanged lectures, "
+        + f"{len(orphans)} outputs removed"
+    )
+    delivery["manifest"] = {**manifest, output_format: outputs}
+    delivery["unchanged_lectures"] = unchanged_lectures
+
+
+def load_manifest(output_dir):
+    try:
+        with open(Path(output_dir, MANIFEST_NAME), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["outputs"]
+
+
+def write_manifest(output_dir, manifest):
+    with atomic_output(Path(output_dir, MANIFEST_NAME)) as partial_manifest:
+        with open(partial_manifest, "w") as manifest_file:
+            json.dump({"version": MANIFEST_VERSION, "outputs": manifest}, manifest_file)
+
+
+def get_file_signature(path):
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def get_directory_signature(directory):
+    signature = hashlib.sha256()
+    for path in sorted(directory.rglob("*")):
+        if path.is_file():
+            signature.update(str(path.relative_to(directory)).encode())
+            signature.update(str(get_file_signature(path)).encode())
+    return signature.hexdigest()
+
+
+def remove_output(output_dir, output, output_dirs):
+    output = Path(output)
+    if ".." in output.parts or output.is_absolute():
+        return  # Never delete anything outside of the output directory
+    output_path = Path(output_dir, output)
+    if output_path.is_symlink() or output_path.is_file():
+        output_path.unlink()
+    # Remove the directories that are left empty, e.g. of a renamed chapter, unless
+    # they are where the outputs of this build go
+    for directory in output.parents:
+        if directory in output_dirs:
+            break
+        try:
+            Path(output_dir, directory).rmdir()
+        except OSError:
+            break
+
+
+def watch_delivery(
+    config_path, args, output_format, action, package_material, index_css
+):
+    delivery = None
+    while True:
+        try:
+            delivery = build_delivery(
+                config_path, args, output_format, action, package_material, index_css
+            )
+        except Exception as e:
+            print(f"Build failed: {e}")
+        watched_paths = get_watched_paths(config_path, delivery)
+        mtimes = get_mtimes(watched_paths)
+        print(f"Watching {len(mtimes)} files for changes, press Ctrl+C to stop")
+
+        while True:
+            try:
+                changes, mtimes = wait_for_changes(watched_paths, mtimes)
+            except KeyboardInterrupt:
+                return
+            if delivery is None or any(kind == "config" for kind, _ in changes):
+                break  # The plan itself may have changed, so build from scratch
+            try:
+                rebuild_delivery(
+                    delivery, changes, args, output_format, action, package_material
+                )
+            except Exception as e:
+                print(f"Rebuild failed: {e}")
+
+
+def get_watched_paths(config_path, delivery):
+    watched_paths = [(config_path, ("config", None))]
+    if delivery is None:
+        return watched_paths
+    assets_dirs = set()
+    for lecture in delivery["lectures"]:
+        watched_paths.append((lecture[0], ("lecture", lecture)))
+        assets_dirs.add(lecture[2])
+    for assets_dir in assets_dirs - {None}:
+        watched_paths.append((assets_dir, ("assets", assets_dir)))
+    for chapter_extras in delivery["extra_paths"].values():
+        for extra_path in chapter_extras["extras"]:
+            watched_paths.append((extra_path, ("extras", None)))
+    watermark_path = get_watermark_path(delivery["config"], delivery["config_dir"])
+    if watermark_path is not None:
+        watched_paths.append((watermark_path, ("watermark", None)))
+    return watched_paths
+
+
+def get_mtimes(watched_paths):
+    mtimes = {}
+    for path, change in watched_paths:
+        files = path.rglob("*") if path.is_dir() else [path]
+        for file in files:
+            try:
+                mtimes[file] = (file.stat().st_mtime_ns, change)
+            except FileNotFoundError:
+                pass
+    return mtimes
+
+
+def wait_for_changes(watched_paths, mtimes):
+    changes = set()
+    while True:
+        time.sleep(WATCH_POLL_SECONDS)
+        new_mtimes = get_mtimes(watched_paths)
+        new_changes = {
+            (new_mtimes.get(file) or mtimes.get(file))[1]
+            for file in mtimes.keys() | new_mtimes.keys()
+            if mtimes.get(file) != new_mtimes.get(file)
+        }
+        mtimes = new_mtimes
+        # Coalesce bursts of changes (e.g. editor saves) until things settle down
+        if changes and not new_changes:
+            return changes, mtimes
+        changes |= new_changes
+
+
+def rebuild_delivery(delivery, changes, args, output_format, action, package_material):
+    change_kinds = {kind for kind, _ in changes}
+    lectures = [
+        lecture
+        for lecture in delivery["lectures"]
+        if ("lecture", lecture) in changes
+        or ("assets", lecture[2]) in changes
+        or ("watermark" in change_kinds and args.watermark_lectures)
+    ]
+    config = delivery["config"]
+    if delivery["render_cache"] is not None:
+        # The render cache remembers the digests of the assets
+        for kind, assets_dir in changes:
+            if kind == "assets":
+                delivery["render_cache"].forget_assets(assets_dir)
+    if lectures:
+        print(f"Rendering {len(lectures)} changed lecture(s)")
+        render_delivery_lectures([(delivery, lectures)], args, output_format, action)
+    if not package_material:
+        if lectures:
+            build_search_index(
+                delivery["table_of_contents"],
+                delivery["lectures"],
+                delivery["output_dir"],
+            )
+        return
+    if lectures or "watermark" in change_kinds:
+        delivery["course_slides"] = build_course_slides(
+            config,
+            delivery["config_dir"],
+            delivery["table_of_contents"],
+            delivery["output_dir"],
+            args.watermark_lectures,
+            args.low_memory,
+        )
+    if "extras" in change_kinds:
+        zip_labs_material(
+            config,
+            delivery["output_dir"],
+            delivery["extra_paths"],
+            args.jobs,
+            not args.no_cache,
+        )
+    if lectures:
+        build_search_index(
+            delivery["table_of_contents"],
+            delivery["lectures"],
+            delivery["output_dir"],
+            delivery["course_slides"],
+        )
+    if lectures or change_kinds & {"watermark", "extras"}:
+        zip_course_material(config, delivery["output_dir"], delivery["course_slides"])
+    print("Rebuild complete")
+
+
+def serve_delivery(config_path, args, index_css):
+    # Only the filetree and the index page are created upfront, the lectures are
+    # rendered by the server when they are requested
+    delivery = plan_delivery(config_path, args, "html")
+    build_search_index(
+        delivery["table_of_contents"], delivery["lectures"], delivery["output_dir"]
+    )
     generate_index_page(
-        table_of_contents,
+        delivery["table_of_contents"],
         index_css,
-        course_slides,
-        course_archive,
-        labs_archive,
-        output_dir,
+        None,
+        None,
+        None,
+        delivery["output_dir"],
+        delivery["config"],
+        False,
+    )
+    server = LectureServer(("localhost", args.port), delivery, args)
+    host, port = server.server_address[:2]
+    print(f"Serving {delivery['name']} at http://{host}:{port}/, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for render_cache in server.render_caches.values():
+            render_cache.evict()
+
+
+class LectureServer(ThreadingHTTPServer):
+    """Serves the output directory of a delivery, rendering lectures on demand"""
+
+    def __init__(self, address, delivery, args):
+        super().__init__(
+            address,
+            functools.partial(
+                LectureRequestHandler, directory=str(delivery["output_dir"])
+            ),
+        )
+        self.config = delivery["config"]
+        self.args = args
+        # Every lecture can be requested as HTML or as PDF
+        self.lectures = {}
+        for lecture_src, lecture_dest, assets_dir in delivery["lectures"]:
+            for suffix in MARP_OUTPUT_FLAGS:
+                lecture = (
+                    lecture_src,
+                    lecture_dest.with_suffix(f".{suffix}"),
+                    assets_dir,
+                )
+                output = lecture[1].relative_to(delivery["output_dir"]).as_posix()
+                self.lectures[output] = lecture
+        self.render_caches = {}
+        if delivery["render_cache"] is not None:
+            self.render_caches["html"] = delivery["render_cache"]
+        self._rendered = {}
+        self._assets_signatures = {}
+        self._lecture_locks = {}
+        self._lock = threading.Lock()
+
+    def render_lecture(self, lecture):
+        lecture_src, lecture_dest, assets_dir = lecture
+        output_format = lecture_dest.suffix.lstrip(".")
+        with self._lock:
+            render_cache = self.render_caches.get(output_format)
+            if render_cache is None and not self.args.no_cache:
+                render_cache = RenderCache(
+                    self.args.cache_dir,
+                    self.args.cache_size * 1024 * 1024,
+                    marp_executable(self.config),
+                    MARP_OUTPUT_FLAGS[output_format],
+                )
+                self.render_caches[output_format] = render_cache
+            lecture_lock = self._lecture_locks.setdefault(
+                lecture_dest, threading.Lock()
+            )
+
+        with lecture_lock:
+            signature = [hashlib.sha256(lecture_src.read_bytes()).hexdigest()]
+            if assets_dir is not None:
+                signature.append(get_directory_signature(assets_dir))
+                with self._lock:
+                    # The render caches remember the digests of the assets
+                    if self._assets_signatures.get(assets_dir) != signature[1]:
+                        for cache in self.render_caches.values():
+                            cache.forget_assets(assets_dir)
+                        self._assets_signatures[assets_dir] = signature[1]
+            if self._rendered.get(lecture_dest) == signature and lecture_dest.exists():
+                return False
+            render_lectures(
+                [lecture],
+                create_pdf if output_format == "pdf" else create_html,
+                self.config,
+                render_cache=render_cache,
+            )
+            self._rendered[lecture_dest] = signature
+            return True
+
+
+class LectureRequestHandler(SimpleHTTPRequestHandler):
+    def send_head(self):
+        output = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        lecture = self.server.lectures.get(output.lstrip("/"))
+        if lecture is not None:
+            try:
+                self.server.render_lecture(lecture)
+            except Exception as e:
+                self.send_error(
+                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                    f"Failed to render {lecture[0].name}: {e}",
+                )
+                return None
+        return super().send_head()
+
+
+@profiled
+def load_config(config_path, args):
+    with open(config_path, "r") as config_file:
+        config = yaml.safe_load(config_file)
+
+    override_config(config, args)
+
+    return config
+
+
+def render_delivery_lectures(deliveries_and_lectures, args, output_format, action):
+    groups = []
+    for delivery, lectures in deliveries_and_lectures:
+        lecture_watermark = None
+        if args.watermark_lectures and output_format == "pdf":
+            lecture_watermark = get_watermark_path(
+                delivery["config"], delivery["config_dir"]
+            )
+        groups.append(
+            (lectures, delivery["config"], delivery["render_cache"], lecture_watermark)
+        )
+    render_lecture_groups(
+        groups,
+        action,
+        args.jobs,
+        args.batch if output_format in MARP_OUTPUT_FLAGS else None,
+    )
+
+
+def build_course_slides(
+    config,
+    config_dir,
+    table_of_contents,
+    output_dir,
+    lectures_watermarked=False,
+    low_memory=False,
+):
+    return merge_course_slides(
         config,
-        package_material,
+        table_of_contents,
+        output_dir,
+        get_watermark_path(config, config_dir),
+        lectures_watermarked,
+        low_memory,
     )
 
 
-def create_filetree(config, config_dir, output_format, action):
+def get_watermark_path(config, config_dir):
+    if "watermark" not in config:
+        return None
+    watermark_path = Path(config["watermark"])
+    return (
+        watermark_path
+        if watermark_path.is_absolute()
+        else Path(config_dir, watermark_path)
+    )
+
+
+def create_filetree(
+    config,
+    config_dir,
+    output_format,
+    action,
+    jobs=1,
+    render_cache=None,
+    batch=None,
+):
+    table_of_contents, output_dir, extra_paths, lectures, _ = plan_filetree(
+        config, config_dir, output_format
+    )
+    render_lectures(lectures, action, config, jobs, render_cache, batch)
+
+    return table_of_contents, output_dir, extra_paths
+
+
+@profiled
+def plan_filetree(config, config_dir, output_format, dry_run=False):
+    # Creates the directories and links of the filetree, unless it's a dry run, and
+    # returns the lectures as (source, destination, assets) for render_lectures
+    # along with the links to the assets
     root_path = Path(config_dir) if "root" not in config else Path(config["root"])
     root_dir = root_path if root_path.is_absolute() else Path(config_dir, root_path)
     default_output = Path("output", config["title"].replace(" ", "_"))
@@ -166,18 +1300,23 @@ def create_filetree(config, config_dir, output_format, action):
 
     table_of_contents = {}
     extra_paths_per_chapter = {}
+    lectures_to_render = []
+    asset_links = []
     for chapter_title, chapter in config["chapters"].items():
         chapter_root = Path(root_dir, "" if "root" not in chapter else chapter["root"])
         chapter_output = Path(output_dir, chapter_title.replace(" ", "_"))
-        chapter_output.mkdir(parents=True, exist_ok=True)
+        if not dry_run:
+            chapter_output.mkdir(parents=True, exist_ok=True)
 
+        assets_dir = None
         if "assets" in chapter:
             assets = Path(chapter["assets"])
             chapter_assets_dest = Path(chapter_output, assets)
-            chapter_assets_dest.unlink(missing_ok=True)
             assets_dir = assets if assets.is_absolute() else Path(chapter_root, assets)
-            chapter_assets_dest.symlink_to(assets_dir, target_is_directory=True)
-            assert chapter_assets_dest.exists(), f"Link is wrong: {chapter_assets_dest}"
+            assert assets_dir.is_dir(), f"Assets {assets_dir} do not exist"
+            if not dry_run:
+                link_assets(chapter_assets_dest, assets_dir)
+            asset_links.append(chapter_assets_dest)
 
         extras = [] if "extras" not in chapter else chapter["extras"]
         chapter_extras = []
@@ -206,8 +1345,7 @@ def create_filetree(config, config_dir, output_format, action):
             lecture_dest = Path(
                 chapter_output, dest_filename.with_suffix(f".{output_format}")
             )
-            lecture_dest.parent.mkdir(parents=True, exist_ok=True)
-            action(lecture_src, lecture_dest, config)
+            lectures_to_render.append((lecture_src, lecture_dest, assets_dir))
             chapter_lectures.append((lecture_title, lecture_dest))
             lecture_number += 1
 
@@ -216,117 +1354,779 @@ def create_filetree(config, config_dir, output_format, action):
     if "assets" in config:
         course_assets = Path(config["assets"])
         course_assets_dest = Path(output_dir, course_assets)
-        course_assets_dest.unlink(missing_ok=True)
         course_assets_dir = (
             course_assets
             if course_assets.is_absolute()
             else Path(root_dir, course_assets)
         )
-        course_assets_dest.symlink_to(course_assets_dir, target_is_directory=True)
-        assert course_assets_dest.exists(), f"Assets don't exist: {course_assets_dest}"
+        assert course_assets_dir.is_dir(), f"Assets {course_assets_dir} do not exist"
+        if not dry_run:
+            link_assets(course_assets_dest, course_assets_dir)
+        asset_links.append(course_assets_dest)
+
+    return (
+        table_of_contents,
+        output_dir,
+        extra_paths_per_chapter,
+        lectures_to_render,
+        asset_links,
+    )
+
+
+def link_assets(assets_dest, assets_dir):
+    if assets_dest.is_symlink() and Path(os.readlink(assets_dest)) == assets_dir:
+        return
+    assets_dest.unlink(missing_ok=True)
+    assets_dest.symlink_to(assets_dir, target_is_directory=True)
+    assert assets_dest.exists(), f"Link is wrong: {assets_dest}"
+
 
-    return table_of_contents, output_dir, extra_paths_per_chapter
+def render_lectures(
+    lectures,
+    action,
+    config,
+    jobs=1,
+    render_cache=None,
+    batch=None,
+    watermark_pdf=None,
+):
+    render_lecture_groups(
+        [(lectures, config, render_cache, watermark_pdf)], action, jobs, batch
+    )
 
 
-def create_links(slide_src, slide_dest, _):
+def render_lecture_groups(groups, action, jobs=1, batch=None):
+    # Every group is a list of lectures with the configuration, render cache and
+    # watermark they are rendered with, e.g. of every delivery of a build, so that
+    # all of them share a single pool of --jobs renders
+    def render(lectures_in_job, config, render_cache, watermark_pdf):
+        # Stamp each lecture as soon as it is ready, while others are still rendering
+        lectures_to_stamp = lectures_in_job if watermark_pdf is not None else []
+        if render_cache is not None:
+            keys = {
+                lecture_dest: render_cache.key(lecture_src, assets_dir)
+                for lecture_src, lecture_dest, assets_dir in lectures_in_job
+            }
+            lectures_in_job = [
+                (lecture_src, lecture_dest, assets_dir)
+                for lecture_src, lecture_dest, assets_dir in lectures_in_job
+                if not render_cache.fetch(keys[lecture_dest], lecture_dest)
+            ]
+        if lectures_in_job and batch is None:
+            for lecture_src, lecture_dest, assets_dir in lectures_in_job:
+                with profile_phase(
+                    lecture_src.name, "lecture", lecture=str(lecture_src)
+                ):
+                    action(lecture_src, lecture_dest, config, assets_dir)
+        elif lectures_in_job:
+            with profile_phase(
+                f"{lectures_in_job[0][1].parent.name} ({len(lectures_in_job)} lectures)",
+                "lecture",
+                lectures=[str(lecture_src) for lecture_src, _, _ in lectures_in_job],
+            ):
+                run_marp_batch(lectures_in_job, config)
+        if render_cache is not None:
+            for _, lecture_dest, _ in lectures_in_job:
+                render_cache.store(keys[lecture_dest], lecture_dest)
+        for _, lecture_dest, _ in lectures_to_stamp:
+            # Recorded here, since the processes of the stamp pool record nothing
+            with profile_phase("add_watermark", lecture=str(lecture_dest)):
+                if stamp_pool is None:
+                    add_watermark(lecture_dest, watermark_pdf)
+                else:
+                    stamp_pool.submit(
+                        add_watermark, lecture_dest, watermark_pdf
+                    ).result()
+
+    # Group the lectures into jobs, either one per lecture or one per marp batch,
+    # which only ever holds lectures of the same group
+    jobs_to_run = {}
+    for group_number, (lectures, *options) in enumerate(groups):
+        for lecture in lectures:
+            lecture_src, lecture_dest, _ = lecture
+            if batch is None:
+                job_name = lecture_src
+            elif batch == "chapter":
+                job_name = lecture_dest.parent
+            elif batch == "course":
+                job_name = "course"
+            else:
+                raise RuntimeError(f"Unknown batch mode: {batch}")
+            job = jobs_to_run.setdefault((group_number, job_name), ([], *options))
+            job[0].append(lecture)
+
+    # Stamping a lecture is CPU bound, so with several jobs the lectures are stamped
+    # in processes, each as soon as it is rendered, to stamp on all the cores
+    lectures_to_stamp = sum(
+        len(lectures)
+        for lectures, _, _, watermark_pdf in groups
+        if watermark_pdf is not None
+    )
+    stamp_pool = None
+    if (jobs or 1) > 1 and lectures_to_stamp > 1:
+        stamp_pool = ProcessPoolExecutor(
+            min(jobs, lectures_to_stamp),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    # The table of contents is already ordered, so lectures can finish in any order
+    # Recorded as render_lectures, however the lectures are grouped
+    with profile_phase("render_lectures"):
+        executor = ThreadPoolExecutor(max_workers=max(1, jobs or 1))
+        try:
+            renders = {
+                executor.submit(render, *job): job_name
+                for (_, job_name), job in jobs_to_run.items()
+            }
+            for render in as_completed(renders):
+                try:
+                    render.result()
+                except Exception as e:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise RuntimeError(f"Failed to render {renders[render]}") from e
+        finally:
+            executor.shutdown(wait=True)
+            if stamp_pool is not None:
+                stamp_pool.shutdown(wait=True)
+
+
+def create_links(slide_src, slide_dest, _, assets_dir=None):
+    if slide_dest.is_symlink() and Path(os.readlink(slide_dest)) == slide_src:
+        return
     slide_dest.unlink(missing_ok=True)
     slide_dest.symlink_to(slide_src)
     assert slide_dest.exists(), f"Link is wrong: {slide_dest}"
 
 
-def create_html(slide_src, slide_dest, config):
-    run_marp(slide_src, slide_dest, config, "--html")
+def create_html(slide_src, slide_dest, config, assets_dir=None):
+    run_marp(
+        slide_src, slide_dest, config, *MARP_OUTPUT_FLAGS["html"], assets_dir=assets_dir
+    )
 
 
-def create_pdf(slide_src, slide_dest, config):
-    # Add both html and pdf arguments to render HTML tags for PDF
-    run_marp(slide_src, slide_dest, config, "--html", "--pdf")
+def create_pdf(slide_src, slide_dest, config, assets_dir=None):
+    run_marp(
+        slide_src, slide_dest, config, *MARP_OUTPUT_FLAGS["pdf"], assets_dir=assets_dir
+    )
 
 
-def run_marp(slide_src, slide_dest, config, *output_type_flags):
-    marp = Path("marp" if "marp" not in config else config["marp-cli"])
-    subprocess.check_call(
-        [
-            marp,
-            slide_src,
-            *output_type_flags,
-            "--allow-local-files",
-            "-o",
-            slide_dest,
-        ]
+def marp_executable(config):
+    return Path("marp" if "marp-cli" not in config else config["marp-cli"])
+
+
+def run_marp(slide_src, slide_dest, config, *output_type_flags, assets_dir=None):
+    if RENDER_NODES:
+        RENDER_NODES.render(slide_src, slide_dest, output_type_flags, assets_dir)
+        return
+    run_marp_command(
+        config,
+        [slide_src, *output_type_flags, "--allow-local-files", "-o", slide_dest],
     )
 
 
-def merge_course_slides(config, table_of_contents, output_dir):
+def run_marp_command(config, marp_args):
+    subprocess.check_call([marp_executable(config), *marp_args])
+
+
+def run_marp_batch(lectures, config):
+    # Without an output argument marp places every output next to its input, so the
+    # lectures are rendered in a temporary mirror of their directories and assets,
+    # where relative paths resolve as they do when rendering them one at a time
+    output_type_flags = MARP_OUTPUT_FLAGS[lectures[0][1].suffix.lstrip(".")]
+    sources = [Path(os.path.abspath(lecture_src)) for lecture_src, _, _ in lectures]
+    lecture_dirs = {source.parent for source in sources}
+    assets_dirs = {
+        Path(os.path.abspath(assets_dir))
+        for _, _, assets_dir in lectures
+        if assets_dir is not None
+    }
+    mirror_root = Path(os.path.commonpath([*lecture_dirs, *assets_dirs]))
+    with tempfile.TemporaryDirectory() as mirror_dir:
+
+        def mirror(path):
+            return Path(mirror_dir, path.relative_to(mirror_root))
+
+        # The outputs are written to real directories, never through links
+        for lecture_dir in lecture_dirs:
+            mirror(lecture_dir).mkdir(parents=True, exist_ok=True)
+        for directory in [*lecture_dirs, *assets_dirs]:
+            link_mirror(directory, mirror(directory))
+        outputs = []
+        for source, (_, lecture_dest, _) in zip(sources, lectures):
+            output = mirror(source).with_suffix(lecture_dest.suffix)
+            output.unlink(missing_ok=True)  # A link to a file next to the source
+            outputs.append(output)
+        run_marp_command(
+            config,
+            [*map(mirror, sources), *output_type_flags, "--allow-local-files"],
+        )
+        for output, (_, lecture_dest, _) in zip(outputs, lectures):
+            assert output.is_file(), f"marp did not render {lecture_dest}"
+            lecture_dest.unlink(missing_ok=True)
+            shutil.copyfile(output, lecture_dest)
+
+
+def link_mirror(source, mirror):
+    # Links source at mirror, or its entries if mirror is a directory already
+    if mirror.is_dir() and not mirror.is_symlink():
+        for entry in source.iterdir():
+            link_mirror(entry, Path(mirror, entry.name))
+    elif not mirror.is_symlink():
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        mirror.symlink_to(source)
+
+
+class RenderNodePool:
+    """Render nodes that lectures are sent to, each to the least busy one"""
+
+    # A request is a JSON line {"lecture": "...", "output": "...", "flags": [...],
+    # "size": 123} followed by a tar of that size with the lecture and its chapter
+    # assets. The answer is {"size": 456} followed by the rendered output, or
+    # {"error": "..."}. A request {"command": "renderer"} is answered with
+    # {"renderer": "..."}, the marp the node renders with
+
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.lock = threading.Lock()
+        self.jobs = {address: 0 for address in self.addresses}
+        self.dead = set()
+        self._renderer = None
+
+    def render(self, lecture_src, lecture_dest, output_type_flags, assets_dir=None):
+        errors = []
+        tried = set()
+        with tempfile.TemporaryDirectory() as job_dir:
+            job_tar = Path(job_dir, "job.tar")
+            job = pack_render_job(
+                lecture_src, lecture_dest, output_type_flags, assets_dir, job_tar
+            )
+            for _ in range(RENDER_NODE_ATTEMPTS):
+                address = self._acquire(tried)
+                if address is None:
+                    break
+                tried.add(address)
+                try:
+                    with atomic_output(lecture_dest) as partial_output:
+                        self._request(address, job, job_tar, partial_output)
+                except (OSError, ValueError) as e:
+                    # The job is given to another node, this one is not used anymore
+                    with self.lock:
+                        self.dead.add(address)
+                    errors.append(f"{format_address(address)} is unreachable: {e}")
+                    continue
+                except RuntimeError as e:
+                    errors.append(f"{format_address(address)} failed: {e}")
+                    continue
+                finally:
+                    with self.lock:
+                        self.jobs[address] -= 1
+                return
+
+        if not errors:
+            errors.append("no render node is reachable")
+        raise RuntimeError(f"Failed to render {lecture_src.name}: {'; '.join(errors)}")
+
+    def renderer(self):
+        # The render cache is keyed on the marp of the nodes rather than a local one
+        with self.lock:
+            if self._renderer is not None:
+                return self._renderer
+        renderers = set()
+        for address in self.addresses:
+            try:
+                response = self._request(address, {"command": "renderer"})
+            except (OSError, ValueError):
+                with self.lock:
+                    self.dead.add(address)
+                continue
+            except RuntimeError:
+                continue
+            renderers.add(response["renderer"])
+        with self.lock:
+            self._renderer = "\n".join(["render nodes", *sorted(renderers)])
+            return self._renderer
+
+    def _acquire(self, tried):
+        # Retries go to nodes that did not get the job yet, if there are any
+        with self.lock:
+            alive = [address for address in self.addresses if address not in self.dead]
+            candidates = [address for address in alive if address not in tried] or alive
+            if not candidates:
+                return None
+            address = min(candidates, key=lambda address: self.jobs[address])
+            self.jobs[address] += 1
+            return address
+
+    def _request(self, address, job, job_tar=None, output=None):
+        import socket
+
+        # The job is read from job_tar and the rendered lecture written to output
+        with socket.create_connection(
+            address, timeout=RENDER_NODE_CONNECT_SECONDS
+        ) as connection:
+            connection.settimeout(RENDER_NODE_RENDER_SECONDS)
+            with connection.makefile("rwb") as stream:
+                try:
+                    write_render_message(stream, job, job_tar)
+                    response = read_render_message(stream, output)
+                except socket.timeout as e:
+                    # A slow render is no reason to think that the node is gone
+                    raise RuntimeError(
+                        f"no answer within {RENDER_NODE_RENDER_SECONDS} s"
+                    ) from e
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+
+def pack_render_job(lecture_src, lecture_dest, output_type_flags, assets_dir, job_tar):
+    import tarfile
+
+    # The chapter assets keep their place relative to the lecture, so that the node
+    # finds them where marp would locally
+    lecture_src = Path(os.path.abspath(lecture_src))
+    assets_dirs = [] if assets_dir is None else [Path(os.path.abspath(assets_dir))]
+    job_root = Path(os.path.commonpath([lecture_src.parent, *assets_dirs]))
+    with tarfile.open(job_tar, mode="w") as tar:
+        tar.add(lecture_src, lecture_src.relative_to(job_root).as_posix())
+        for assets_dir in assets_dirs:
+            tar.add(assets_dir, assets_dir.relative_to(job_root).as_posix())
+    return {
+        "lecture": lecture_src.relative_to(job_root).as_posix(),
+        "output": lecture_dest.name,
+        "flags": list(output_type_flags),
+    }
+
+
+def write_render_message(stream, message, payload_path=None):
+    # The payload is copied in chunks, so that neither side holds it in memory
+    size = 0 if payload_path is None else payload_path.stat().st_size
+    stream.write((json.dumps({**message, "size": size}) + "\n").encode())
+    if payload_path is not None:
+        with open(payload_path, "rb") as payload:
+            shutil.copyfileobj(payload, stream, RENDER_NODE_CHUNK_SIZE)
+    stream.flush()
+
+
+def read_render_message(stream, payload_path=None):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    message = json.loads(line)
+    remaining = message["size"]
+    if remaining and payload_path is None:
+        raise ValueError("Unexpected payload")
+    if payload_path is None:
+        return message
+    with open(payload_path, "wb") as payload:
+        while remaining:
+            chunk = stream.read(min(remaining, RENDER_NODE_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            payload.write(chunk)
+            remaining -= len(chunk)
+    return message
+
+
+def serve_render_node(address, args):
+    import socketserver
+
+    config = {"marp-cli": args.marp_cli}
+    renderer = describe_renderer(marp_executable(config))
+    renders = threading.Semaphore(max(1, args.jobs or 1))
+
+    class RenderNodeHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            with tempfile.TemporaryDirectory() as job_dir:
+                job_tar = Path(job_dir, "job.tar")
+                try:
+                    job = read_render_message(self.rfile, job_tar)
+                except (OSError, ValueError):
+                    return
+                if job.get("command") == "renderer":
+                    write_render_message(self.wfile, {"renderer": renderer})
+                    return
+                try:
+                    with renders:
+                        output = render_job(Path(job_dir), job, job_tar, config)
+                except Exception as e:
+                    write_render_message(self.wfile, {"error": str(e)})
+                    return
+                write_render_message(self.wfile, {}, output)
+
+    server = socketserver.ThreadingTCPServer(address, RenderNodeHandler)
+    server.daemon_threads = True
+    print(f"Render node listening on {format_address(address)}, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def render_job(job_dir, job, job_tar, config):
+    import tarfile
+
+    # The jobs come from the network, so they are checked even when run with -O
+    if not all(flag in RENDER_NODE_FLAGS for flag in job["flags"]):
+        raise RuntimeError(f"Unsupported flags {job['flags']}")
+    lectures_dir = Path(job_dir, "job")
+    with tarfile.open(job_tar) as tar:
+        tar.extractall(lectures_dir, filter="data")
+    lecture = Path(lectures_dir, job["lecture"]).resolve()
+    if not lecture.is_relative_to(lectures_dir.resolve()):
+        raise RuntimeError(f"Bad lecture {job['lecture']}")
+    output = Path(job_dir, Path(job["output"]).name)
+    run_marp(lecture, output, config, *job["flags"])
+    return output
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+class RenderCache:
+    """Content-addressed store of rendered lectures with LRU eviction"""
+
+    def __init__(self, cache_dir, max_size, marp, output_flags):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.output_flags = list(output_flags)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._assets_digests = {}
+        if RENDER_NODES:
+            self._renderer = RENDER_NODES.renderer()
+        else:
+            self._renderer = describe_renderer(marp)
+
+    def key(self, lecture_src, assets_dir):
+        digest = hashlib.sha256()
+        digest.update(self._renderer.encode())
+        digest.update(" ".join(self.output_flags).encode())
+        digest.update(Path(lecture_src).read_bytes())
+        if assets_dir is not None:
+            digest.update(self._assets_digest(Path(assets_dir)).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key, lecture_dest):
+        cached = Path(self.cache_dir, key + Path(lecture_dest).suffix)
+        try:
+            lecture_dest.unlink(missing_ok=True)
+            shutil.copyfile(cached, lecture_dest)
+            os.utime(cached)  # Mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, lecture_dest):
+        cached = Path(self.cache_dir, key + Path(lecture_dest).suffix)
+        # Copy under a temporary name so that concurrent builds never see partial files
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as partial:
+            with open(lecture_dest, "rb") as rendered:
+                shutil.copyfileobj(rendered, partial)
+        Path(partial.name).replace(cached)
+
+    def evict(self):
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in self.cache_dir.iterdir()
+            if entry.is_file()
+        ]
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda entry: entry[0]):
+            if cache_size <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            cache_size -= size
+
+    def forget_assets(self, assets_dir):
+        with self._lock:
+            self._assets_digests.pop(Path(assets_dir), None)
+
+    def _assets_digest(self, assets_dir):
+        with self._lock:
+            if assets_dir in self._assets_digests:
+                return self._assets_digests[assets_dir]
+        digest = hashlib.sha256()
+        for asset in sorted(assets_dir.rglob("*")):
+            if asset.is_file():
+                digest.update(str(asset.relative_to(assets_dir)).encode())
+                digest.update(hashlib.sha256(asset.read_bytes()).digest())
+        with self._lock:
+            self._assets_digests[assets_dir] = digest.hexdigest()
+        return self._assets_digests[assets_dir]
+
+
+def describe_renderer(marp):
+    marp_path = shutil.which(marp) or str(marp)
+    try:
+        marp_version = subprocess.run(
+            [marp_path, "--version"], capture_output=True, text=True
+        ).stdout
+    except OSError:
+        marp_version = ""
+    return f"{marp_path}\n{marp_version}"
+
+
+@profiled
+def merge_course_slides(
+    config,
+    table_of_contents,
+    output_dir,
+    watermark_pdf=None,
+    lectures_watermarked=False,
+    low_memory=False,
+):
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import AnnotationBuilder
+
+    # Count the pages of every lecture first, so that the table of contents can be
+    # placed in front and everything is merged and written in a single pass
     chapters_and_pages = []  # To be used to generate the table of contents
-    with PdfWriter() as contents_merger:
-        for chapter_title, chapter_slides in table_of_contents.items():
-            chapter_contents = []
-            for slide_title, slide_path in chapter_slides:
-                chapter_contents.append(
-                    {
-                        "slide_title": slide_title,
-                        "page_number": len(contents_merger.pages) + 2,
-                    }
+    lecture_readers = []
+    page_number = 0  # Relative to the first lecture, i.e. after the contents
+    for chapter_title, chapter_slides in table_of_contents.items():
+        chapter_contents = []
+        for slide_title, slide_path in chapter_slides:
+            lecture_reader = PdfReader(slide_path)
+            chapter_contents.append(
+                {"slide_title": slide_title, "page_number": page_number}
+            )
+            # With low memory the lectures are read again one at a time when merging
+            lecture_readers.append(
+                (
+                    chapter_title,
+                    slide_title,
+                    slide_path if low_memory else lecture_reader,
                 )
-                contents_merger.append(slide_path, outline_item=slide_title)
-
-            chapters_and_pages.append(
-                {"chapter_title": chapter_title, "contents": chapter_contents}
             )
+            page_number += len(lecture_reader.pages)
+            if low_memory:
+                release_reader(lecture_reader)
 
-        # Add the contents pdf to a temporary file
-        merged_contents_path = Path(tempfile.gettempdir(), "merged_contents.pdf")
-        contents_merger.write(merged_contents_path)
+        chapters_and_pages.append(
+            {"chapter_title": chapter_title, "contents": chapter_contents}
+        )
 
     toc_path = create_toc(config["title"], chapters_and_pages)
-    toc_reader = PdfReader(toc_path)
-    with PdfWriter() as toc_merger:
-        # Preseve the size of the TOC page
-        # If we append directly then the TOC gets a weird shape
-        toc_page_width = toc_reader.pages[0].mediabox.width
-        toc_page_height = toc_reader.pages[0].mediabox.height
-        toc_reader.pages[0].scale_to(toc_page_width, toc_page_height)
-        toc_merger.add_page(toc_reader.pages[0])
+    if low_memory:
+        try:
+            return stream_course_slides(
+                config,
+                output_dir,
+                toc_path,
+                chapters_and_pages,
+                lecture_readers,
+                watermark_pdf,
+                lectures_watermarked,
+            )
+        finally:
+            Path(toc_path).unlink(missing_ok=True)
+
+    try:
+        toc_reader = PdfReader(toc_path)
+        toc_pages = len(toc_reader.pages)
+        course_merger = PdfWriter()
+        for toc_page in toc_reader.pages:
+            # Preseve the size of the TOC page
+            # If we append directly then the TOC gets a weird shape
+            toc_page.scale_to(toc_page.mediabox.width, toc_page.mediabox.height)
+            course_merger.add_page(toc_page)
+    finally:
+        Path(toc_path).unlink(missing_ok=True)
+
+    with course_merger:
+        contents_outline = course_merger.add_outline_item("Contents", 0)
+        chapter_outline = None
+        previous_chapter = None
+        for chapter_title, slide_title, lecture_reader in lecture_readers:
+            first_page = len(course_merger.pages)
+            course_merger.append(lecture_reader, import_outline=False)
+            if chapter_title != previous_chapter:
+                chapter_outline = course_merger.add_outline_item(
+                    chapter_title, first_page, parent=contents_outline
+                )
+                previous_chapter = chapter_title
+            course_merger.add_outline_item(
+                slide_title, first_page, parent=chapter_outline
+            )
 
-        toc_merger.append(merged_contents_path, outline_item="Contents")
+        if watermark_pdf is not None:
+            watermark = add_watermark_xobject(course_merger, watermark_pdf)
+            # Stamp only the table of contents if the lectures are already stamped
+            pages_to_stamp = course_merger.pages[
+                : toc_pages if lectures_watermarked else None
+            ]
+            with profile_phase("stamp_pages"):
+                for page in pages_to_stamp:
+                    stamp_page(page, watermark)
 
         for chapter in chapters_and_pages:
             for slide in chapter["contents"]:
-                mediabox_height = toc_merger.pages[0].mediabox.height
-                # In the fpdf library, the origin is at the top left corner
-                # so we need to invert the y coordinates to match pypdf
-                slide["rect"] = (
-                    slide["rect"][0],
-                    mediabox_height - slide["rect"][1],
-                    slide["rect"][2],
-                    mediabox_height - slide["rect"][3],
+                toc_page = slide["toc_page"]
+                slide["rect"] = get_toc_link_rect(
+                    slide, course_merger.pages[toc_page].mediabox.height
                 )
-                toc_merger.add_annotation(
-                    0,
+                target_page_index = slide["page_number"] - 1  # 0-based
+                course_merger.add_annotation(
+                    toc_page,
                     AnnotationBuilder.link(
-                        rect=slide["rect"],
-                        target_page_index=slide["page_number"] - 1,  # 0-based
+                        rect=slide["rect"], target_page_index=target_page_index
                     ),
                 )
+                # pypdf leaves the page index as the destination, which only
+                # remote links may use, so refer to the page itself
+                link = course_merger.pages[toc_page]["/Annots"][-1].get_object()
+                link["/Dest"][0] = course_merger.pages[
+                    target_page_index
+                ].indirect_reference
+
+        if config.get("recompress_slides", False):
+            recompress_streams(course_merger)
+        print_deduplication(*deduplicate_objects(course_merger))
+
+        course_slides = get_course_slides_path(config, output_dir)
+        with atomic_output(course_slides) as partial_course_slides:
+            course_merger.write(partial_course_slides)
+            if config.get("linearize", False):
+                linearize_pdf(partial_course_slides)
 
-        course_slides = Path(
-            f'{config["title"].replace(" ", "_")}.pdf'
-            if "course_slides" not in config
-            else config["course_slides"]
-        )
-        course_slides = (
-            course_slides
-            if course_slides.is_absolute()
-            else Path(output_dir, course_slides)
-        )
-        toc_merger.write(course_slides)
+    return course_slides
+
+
+@profiled
+def stream_course_slides(
+    config,
+    output_dir,
+    toc_path,
+    chapters_and_pages,
+    lectures,
+    watermark_pdf=None,
+    lectures_watermarked=False,
+):
+    from pypdf import PdfReader
+    from pypdf.generic import ArrayObject, NameObject
+
+    # Every lecture is written to the course slides as soon as it is read, so the
+    # memory needed does not grow with the size of the course. The contents come
+    # first in the course slides but are written last, when the pages to link to
+    # have their object numbers
+    course_slides = get_course_slides_path(config, output_dir)
+    with atomic_output(course_slides) as partial_course_slides:
+        with open(partial_course_slides, "wb") as course_file:
+            course_writer = StreamingPdfWriter(
+                course_file, config.get("recompress_slides", False)
+            )
+            watermark = None
+            if watermark_pdf is not None:
+                with profile_phase("add_watermark_xobject"):
+                    watermark = course_writer.add_watermark(watermark_pdf)
+
+            lecture_pages = []
+            outline = []
+            for chapter_title, slide_title, lecture_path in lectures:
+                lecture_reader = PdfReader(lecture_path)
+                if watermark is not None and not lectures_watermarked:
+                    with profile_phase("stamp_pages"):
+                        for page in lecture_reader.pages:
+                            stamp_page(page, watermark)
+                pages = course_writer.append_pages(lecture_reader)
+                release_reader(lecture_reader)
+                if not outline or outline[-1][0] != chapter_title:
+                    outline.append((chapter_title, pages[0], []))
+                outline[-1][2].append((slide_title, pages[0], []))
+                lecture_pages += pages
+
+            toc_reader = PdfReader(toc_path)
+            for chapter in chapters_and_pages:
+                for slide in chapter["contents"]:
+                    toc_page = toc_reader.pages[slide["toc_page"]]
+                    target_page = lecture_pages[
+                        slide["page_number"] - len(toc_reader.pages) - 1
+                    ]
+                    rect = get_toc_link_rect(slide, toc_page.mediabox.height)
+                    toc_page.setdefault(NameObject("/Annots"), ArrayObject()).append(
+                        course_writer.add_link(rect, target_page)
+                    )
+            if watermark is not None:
+                for page in toc_reader.pages:
+                    stamp_page(page, watermark)
+            toc_pages = course_writer.append_pages(toc_reader)
+
+            course_writer.finish(
+                toc_pages + lecture_pages, [("Contents", toc_pages[0], outline)]
+            )
+        if config.get("linearize", False):
+            linearize_pdf(partial_course_slides)
+    print_deduplication(course_writer.duplicates, course_writer.saved_bytes)
 
     return course_slides
 
 
-def zip_course_material(config, output_dir, extra_paths, course_slides):
-    course_slides = Path(output_dir, course_slides)
+def release_reader(reader):
+    # The objects a reader resolved refer back to it, so it and the file it read
+    # would only be freed by the garbage collector, which may not run for a while.
+    # Without them, the reader is small and the objects are freed right away
+    reader.resolved_objects.clear()
+    reader.flattened_pages = None
+    reader.stream.close()
+
+
+@profiled
+def linearize_pdf(pdf_path):
+    # Linearized PDFs start with the first page and hint tables on where the rest
+    # are, so viewers can show them before the whole file is downloaded
+    qpdf = shutil.which("qpdf")
+    assert qpdf, "qpdf is needed to linearize the course slides"
+    linearized_pdf = Path(pdf_path.parent, pdf_path.name + ".linearized")
+    try:
+        # qpdf exits with 3 when it succeeded with warnings
+        result = subprocess.run([qpdf, "--linearize", pdf_path, linearized_pdf])
+        if result.returncode not in (0, 3):
+            raise RuntimeError(f"qpdf failed to linearize {pdf_path}")
+        linearized_pdf.replace(pdf_path)
+    finally:
+        linearized_pdf.unlink(missing_ok=True)
+
+
+def get_toc_link_rect(slide, mediabox_height):
+    # In the fpdf library, the origin is at the top left corner
+    # so we need to invert the y coordinates to match pypdf
+    return (
+        slide["rect"][0],
+        mediabox_height - slide["rect"][1],
+        slide["rect"][2],
+        mediabox_height - slide["rect"][3],
+    )
+
+
+def get_course_slides_path(config, output_dir):
+    course_slides = Path(
+        f'{config["title"].replace(" ", "_")}.pdf'
+        if "course_slides" not in config
+        else config["course_slides"]
+    )
+    return (
+        course_slides
+        if course_slides.is_absolute()
+        else Path(output_dir, course_slides)
+    )
+
+
+def get_archive_paths(config, output_dir):
     course_archive = Path(
         f'{config["title"].replace(" ", "_")}.zip'
         if "course_archive" not in config
@@ -337,50 +2137,247 @@ def zip_course_material(config, output_dir, extra_paths, course_slides):
         if course_archive.is_absolute()
         else Path(output_dir, course_archive)
     )
-    with ZipFile(course_archive, "w") as zip_file:
-        # Add slides
-        zip_file.write(course_slides, course_slides.name)
-        # Add extra files
-        for chapter_title, chapter_extras in extra_paths.items():
-            chapter_title = chapter_title.replace(" ", "_")
-            chapter_root = chapter_extras["root"]
-            for extra_path in chapter_extras["extras"]:
-                # If the path is a directory, add all files in it preserving the directory structure
-                relative_to_chapter_root = extra_path.is_relative_to(chapter_root)
-                if extra_path.is_dir():
-                    for extra_file in extra_path.rglob("*"):
-                        zip_file.write(
+    labs_archive = Path(
+        course_archive.parent, course_archive.stem + "-labs" + course_archive.suffix
+    )
+    return course_archive, labs_archive
+
+
+@profiled
+def zip_labs_material(config, output_dir, extra_paths, jobs=1, reuse=True):
+    _, labs_archive = get_archive_paths(config, output_dir)
+    archive_entries = []
+    for chapter_title, chapter_extras in extra_paths.items():
+        chapter_title = chapter_title.replace(" ", "_")
+        chapter_root = chapter_extras["root"]
+        for extra_path in chapter_extras["extras"]:
+            # If the path is a directory, add all files in it preserving the directory structure
+            relative_to_chapter_root = extra_path.is_relative_to(chapter_root)
+            if extra_path.is_dir():
+                for extra_file in extra_path.rglob("*"):
+                    archive_entries.append(
+                        (
                             extra_file,
                             Path(
                                 chapter_title,
-                                extra_file.relative_to(chapter_root)
-                                if relative_to_chapter_root
-                                else extra_file.relative_to(extra_path.parent),
+                                (
+                                    extra_file.relative_to(chapter_root)
+                                    if relative_to_chapter_root
+                                    else extra_file.relative_to(extra_path.parent)
+                                ),
                             ),
                         )
-                else:
-                    zip_file.write(
+                    )
+            else:
+                archive_entries.append(
+                    (
                         extra_path,
                         Path(
                             chapter_title,
-                            extra_path.relative_to(chapter_root)
-                            if relative_to_chapter_root
-                            else extra_path.name,
+                            (
+                                extra_path.relative_to(chapter_root)
+                                if relative_to_chapter_root
+                                else extra_path.name
+                            ),
                         ),
                     )
+                )
+
+    compression = get_archive_compression(config)
+    with atomic_output(labs_archive) as partial_archive:
+        reused_entries = write_archive(
+            partial_archive,
+            archive_entries,
+            compression,
+            jobs,
+            labs_archive if reuse else None,
+        )
+    if reused_entries:
+        print(f"Reused {reused_entries} unchanged entries of {labs_archive.name}")
+
+    return labs_archive
+
+
+@profiled
+def zip_course_material(config, output_dir, course_slides):
+    from zipfile import ZipFile
+
+    course_slides = Path(output_dir, course_slides)
+    course_archive, labs_archive = get_archive_paths(config, output_dir)
+    compression = get_archive_compression(config)
+    # The course archive is the labs archive plus the slides, so copy the already
+    # compressed labs archive as is and append the slides to it
+    with atomic_output(course_archive) as partial_archive:
+        shutil.copyfile(labs_archive, partial_archive)
+        with ZipFile(partial_archive, "a") as zip_file:
+            zip_file.write(
+                course_slides,
+                course_slides.name,
+                *get_entry_compression(course_slides, compression),
+            )
 
     return course_archive
 
 
-def delete_from_archive(original_archive, path_to_remove, output_archive):
-    with ZipFile(original_archive, "r") as original:
-        with ZipFile(output_archive, "w") as output:
-            for item in original.infolist():
-                file = original.read(item.filename)
-                if item.filename != path_to_remove:
-                    output.writestr(item.filename, file)
+def get_archive_compression(config):
+    import zipfile
+
+    compression = config.get("compression", {})
+    method = compression.get("method", ARCHIVE_DEFAULT_COMPRESSION)
+    assert method in ARCHIVE_COMPRESSION_METHODS, f"Unknown compression: {method}"
+    reuse = compression.get("reuse", ARCHIVE_DEFAULT_REUSE)
+    assert reuse in ARCHIVE_REUSE_CHECKS, f"Unknown archive reuse check: {reuse}"
+    return {
+        "method": getattr(zipfile, ARCHIVE_COMPRESSION_METHODS[method]),
+        "level": compression.get("level"),
+        "store": [
+            suffix.lower()
+            for suffix in compression.get("store", ARCHIVE_DEFAULT_STORED_SUFFIXES)
+        ],
+        "reuse": reuse,
+    }
 
 
+def get_entry_compression(path, compression):
+    from zipfile import ZIP_STORED
+
+    if path.is_dir() or path.suffix.lower() in compression["store"]:
+        return ZIP_STORED, None
+    return compression["method"], compression["level"]
+
+
+@profiled
+def write_archive(archive, archive_entries, compression, jobs=1, previous_archive=None):
+    from zipfile import ZipFile, ZIP_STORED
+
+    # Entries are compressed in parallel into single-entry archives, which are then
+    # copied in order into the final archive without being decompressed again.
+    # Unchanged entries of the previous archive are copied from it the same way
+    previous_zip_file = open_previous_archive(previous_archive, compression)
+    reused_entries = 0
+    with ZipFile(archive, "w") as zip_file, tempfile.TemporaryDirectory(
+        dir=Path(archive).parent
+    ) as compressed_dir, ThreadPoolExecutor(
+        max(1, jobs or 1)
+    ) as executor, previous_zip_file or nullcontext():
+
+        def compress(index, path, arcname, compress_type, compress_level):
+            compressed_archive = Path(compressed_dir, f"{index}.zip")
+            with ZipFile(compressed_archive, "w") as compressed:
+                compressed.write(path, arcname, compress_type, compress_level)
+            return compressed_archive
+
+        def add_to_archive(path, arcname, compressing, previous_entry):
+            if previous_entry is not None:
+                copy_archive_entry(previous_zip_file, previous_entry, zip_file)
+                return
+            if compressing is None:
+                zip_file.write(path, arcname, ZIP_STORED)
+                return
+            compressed_archive = compressing.result()
+            with ZipFile(compressed_archive, "r") as compressed:
+                copy_archive_entry(compressed, compressed.infolist()[0], zip_file)
+            compressed_archive.unlink()
+
+        # Limit how far compression runs ahead of writing to bound the disk usage
+        max_pending_entries = 2 * max(1, jobs or 1)
+        pending_entries = deque()
+        for index, (path, arcname) in enumerate(archive_entries):
+            compress_type, compress_level = get_entry_compression(path, compression)
+            compressing = None
+            previous_entry = find_previous_entry(
+                previous_zip_file, path, arcname, compress_type, compression["reuse"]
+            )
+            if previous_entry is not None:
+                reused_entries += 1
+            elif compress_type != ZIP_STORED:
+                compressing = executor.submit(
+                    compress, index, path, arcname, compress_type, compress_level
+                )
+            pending_entries.append((path, arcname, compressing, previous_entry))
+            if len(pending_entries) >= max_pending_entries:
+                add_to_archive(*pending_entries.popleft())
+        while pending_entries:
+            add_to_archive(*pending_entries.popleft())
+
+    return reused_entries
+
+
+def open_previous_archive(previous_archive, compression):
+    import zipfile
+
+    if (
+        previous_archive is None
+        or compression["reuse"] == "never"
+        or not Path(previous_archive).is_file()
+    ):
+        return None
+    try:
+        return zipfile.ZipFile(previous_archive, "r")
+    except zipfile.BadZipFile:
+        return None  # e.g. an archive that was not written completely
+
+
+def find_previous_entry(previous_zip_file, path, arcname, compress_type, reuse):
+    import zipfile
+
+    if previous_zip_file is None:
+        return None
+    # Whatever the check, an entry compressed at another level is still reused, so
+    # --no-cache, which passes no previous archive, is needed to recompress it
+    entry = zipfile.ZipInfo.from_file(path, arcname)
+    previous_entry = previous_zip_file.NameToInfo.get(entry.filename)
+    if (
+        previous_entry is None
+        or previous_entry.file_size != entry.file_size
+        or previous_entry.compress_type != compress_type
+    ):
+        return None
+    if reuse == "mtime":
+        # Zip timestamps have a resolution of two seconds, rounded down
+        date_time = (*entry.date_time[:5], entry.date_time[5] // 2 * 2)
+        return previous_entry if previous_entry.date_time == date_time else None
+    if entry.is_dir():
+        return previous_entry
+    crc = 0
+    with open(path, "rb") as entry_file:
+        while chunk := entry_file.read(ARCHIVE_COPY_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return previous_entry if previous_entry.CRC == crc else None
+
+
+def copy_archive_entry(source, entry, destination):
+    import zipfile
+
+    # zipfile cannot copy compressed data, so skip the local header of the entry
+    # and copy its compressed bytes as they are, after a new local header
+    source.fp.seek(entry.header_offset)
+    local_header = struct.unpack(
+        zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader)
+    )
+    source.fp.seek(
+        local_header[zipfile._FH_FILENAME_LENGTH]
+        + local_header[zipfile._FH_EXTRA_FIELD_LENGTH],
+        os.SEEK_CUR,
+    )
+    copied_entry = copy.copy(entry)
+    copied_entry.flag_bits &= ~0x08  # Sizes are known, so no data descriptor
+    copied_entry.extra = zipfile._strip_extra(entry.extra, (1,))  # Zip64 sizes
+    copied_entry.header_offset = destination.fp.tell()
+    destination.fp.write(copied_entry.FileHeader())
+    remaining_bytes = entry.compress_size
+    while remaining_bytes > 0:
+        chunk = source.fp.read(min(remaining_bytes, ARCHIVE_COPY_CHUNK_SIZE))
+        assert chunk, f"Archive entry {entry.filename} is truncated"
+        destination.fp.write(chunk)
+        remaining_bytes -= len(chunk)
+    destination.filelist.append(copied_entry)
+    destination.NameToInfo[copied_entry.filename] = copied_entry
+    destination.start_dir = destination.fp.tell()
+    destination._didModify = True
+
+
+@profiled
 def generate_index_page(
     table_of_contents,
     index_css,
@@ -392,7 +2389,9 @@ def generate_index_page(
     package_material,
 ):
     index_path = Path(output_dir, "index.html")
-    with open(index_path, "w") as index_file:
+    with atomic_output(index_path) as partial_index, open(
+        partial_index, "w"
+    ) as index_file:
         doc, tag, text = Doc().tagtext()
         with tag("html"):
             with tag("head"):
@@ -404,6 +2403,16 @@ def generate_index_page(
                 # Title
                 with tag("h1"):
                     text(config["title"])
+                # Search
+                doc.stag(
+                    "input",
+                    type="search",
+                    id="search",
+                    placeholder="Search the slides",
+                    oninput="search(this.value)",
+                )
+                with tag("ul", id="search-results"):
+                    pass
                 # Table of contents
                 with tag("ol", type="1"):
                     for chapter_title, chapter_lectures in table_of_contents.items():
@@ -427,35 +2436,629 @@ def generate_index_page(
                     doc.stag("br")
                     with tag("a", href=f"{course_archive}", style="font-size: 24pt"):
                         text("Course archive")
+                with tag("script", src=SEARCH_INDEX_NAME):
+                    pass
+                with tag("script"):
+                    doc.asis(INDEX_SEARCH_SCRIPT)
         index_file.write(indent(doc.getvalue(), indent_text=True))
         print(f"Generated course page at: {index_path.resolve()}")
 
 
+@profiled
+def build_search_index(table_of_contents, lectures, output_dir, course_slides=None):
+    # The terms of lectures whose Markdown did not change are taken from the cache
+    # of the previous build instead of being extracted again
+    cache_path = Path(output_dir, SEARCH_CACHE_NAME)
+    try:
+        with open(cache_path, "r") as cache_file:
+            previous_cache = json.load(cache_file)
+    except (OSError, ValueError):
+        previous_cache = {}
+    if previous_cache.get("version") != SEARCH_CACHE_VERSION:
+        previous_cache = {"lectures": {}}
+
+    lecture_sources = {
+        lecture_dest: lecture_src for lecture_src, lecture_dest, _ in lectures
+    }
+    first_pages = get_lecture_first_pages(course_slides) if course_slides else []
+    cache = {}
+    index_lectures = []
+    terms = {}
+    reused = 0
+    for chapter_title, chapter_lectures in table_of_contents.items():
+        for lecture_title, lecture_dest in chapter_lectures:
+            lecture_src = lecture_sources[lecture_dest]
+            signature = get_file_signature(lecture_src)
+            cached = previous_cache["lectures"].get(str(lecture_src))
+            if cached is not None and cached["signature"] == signature:
+                slides = cached["slides"]
+                reused += 1
+            else:
+                slides = extract_slide_terms(lecture_src.read_text())
+            cache[str(lecture_src)] = {"signature": signature, "slides": slides}
+
+            lecture_number = len(index_lectures)
+            for slide_number, slide_terms in enumerate(slides, 1):
+                for term in slide_terms:
+                    terms.setdefault(term, []).extend((lecture_number, slide_number))
+            index_lectures.append(
+                [
+                    chapter_title,
+                    lecture_title,
+                    lecture_dest.relative_to(output_dir).as_posix(),
+                    (
+                        first_pages[lecture_number]
+                        if len(first_pages) == len(lecture_sources)
+                        else None
+                    ),
+                ]
+            )
+
+    search_index = {
+        "lectures": index_lectures,
+        "terms": terms,
+        "course_slides": (
+            Path(course_slides).relative_to(output_dir).as_posix()
+            if course_slides is not None
+            and Path(course_slides).is_relative_to(output_dir)
+            else None
+        ),
+    }
+    with atomic_output(Path(output_dir, SEARCH_INDEX_NAME)) as partial_index:
+        with open(partial_index, "w") as index_file:
+            index_file.write("window.EELY_SEARCH_INDEX = ")
+            json.dump(search_index, index_file, separators=(",", ":"))
+            index_file.write(";\n")
+    with atomic_output(cache_path) as partial_cache:
+        with open(partial_cache, "w") as cache_file:
+            json.dump({"version": SEARCH_CACHE_VERSION, "lectures": cache}, cache_file)
+    print(
+        f"Search index: {len(terms)} terms in {len(index_lectures)} lectures, "
+        + f"{reused} unchanged lectures reused"
+    )
+
+
+def extract_slide_terms(markdown):
+    # Returns the terms of each slide, slides being separated as in marp by ---
+    # lines outside of fenced code and by the headings that the headingDivider
+    # directive names, after the front matter with the directives and without
+    # comments
+    heading_divider = None
+    front_matter = re.match(r"---[ \t]*\n(.*?)^---[ \t]*$", markdown, re.DOTALL | re.M)
+    if front_matter:
+        directives = load_directive(front_matter.group(1))
+        if isinstance(directives, dict):
+            heading_divider = directives.get("headingDivider")
+        markdown = markdown[front_matter.end() :]
+    # Directives in comments override the front matter
+    for directive in re.findall(r"<!--\s*headingDivider:(.*?)-->", markdown, re.DOTALL):
+        heading_divider = load_directive(directive)
+    markdown = re.sub(r"<!--.*?-->", " ", markdown, flags=re.DOTALL)
+
+    # A number splits at the headings up to its level, a list at those levels only
+    if isinstance(heading_divider, list):
+        heading_levels = set(heading_divider)
+    elif isinstance(heading_divider, int) and not isinstance(heading_divider, bool):
+        heading_levels = set(range(1, heading_divider + 1))
+    else:
+        heading_levels = set()
+    slides = [[]]
+    fence = None
+    for line in markdown.split("\n"):
+        if fence is not None:
+            if re.fullmatch(rf" {{0,3}}{fence[0]}{{{len(fence)},}}[ \t]*", line):
+                fence = None
+        elif re.fullmatch(r"---[ \t]*", line):
+            slides.append([])
+            continue
+        elif opening_fence := re.match(r" {0,3}(`{3,}|~{3,})", line):
+            fence = opening_fence.group(1)
+        else:
+            heading = re.match(r" {0,3}(#{1,6})(?:[ \t]|$)", line)
+            # A heading that starts a slide does not start another one
+            if (
+                heading
+                and len(heading.group(1)) in heading_levels
+                and any(slide_line.strip() for slide_line in slides[-1])
+            ):
+                slides.append([])
+        slides[-1].append(line)
+
+    slide_terms = []
+    for slide in slides:
+        # Link and image targets are paths rather than content
+        text = re.sub(r"\]\([^)]*\)", "]", "\n".join(slide)).lower()
+        slide_terms.append(sorted(set(re.findall(r"[^\W_]{2,}", text))))
+    return slide_terms
+
+
+def load_directive(directive):
+    try:
+        return yaml.safe_load(directive)
+    except yaml.YAMLError:
+        return None
+
+
+def get_lecture_first_pages(course_slides):
+    from pypdf import PdfReader
+
+    # The outline of the course slides has an item for every lecture, below the
+    # item of its chapter inside the contents
+    reader = PdfReader(course_slides)
+    outline = reader.outline
+    if len(outline) < 2 or not isinstance(outline[1], list):
+        return []
+    return [
+        reader.get_destination_page_number(lecture) + 1
+        for chapter_lectures in outline[1]
+        if isinstance(chapter_lectures, list)
+        for lecture in chapter_lectures
+    ]
+
+
 def add_watermark(content_pdf, watermark_pdf):
-    # Adapted from https://pypdf.readthedocs.io/en/stable/user/add-watermark.html
-    reader = PdfReader(content_pdf)
-    page_indices = range(len(reader.pages))
+    from pypdf import PdfWriter
 
     writer = PdfWriter()
+    writer.append(content_pdf)
+    watermark = add_watermark_xobject(writer, watermark_pdf)
+    for content_page in writer.pages:
+        stamp_page(content_page, watermark)
+
+    with atomic_output(Path(content_pdf)) as pdf_result, open(pdf_result, "wb") as fp:
+        writer.write(fp)
+
+
+@profiled
+def add_watermark_xobject(writer, watermark_pdf):
+    from pypdf import PdfReader
+    from pypdf.generic import (
+        ArrayObject,
+        DecodedStreamObject,
+        DictionaryObject,
+        NameObject,
+    )
+
+    # The watermark is embedded once as a form XObject that every stamped page
+    # refers to, instead of copying its content and resources into each page
     watermark_page = PdfReader(watermark_pdf).pages[0]
-    for index in page_indices:
-        content_page = reader.pages[index]
-        content_page.merge_transformed_page(
-            watermark_page,
-            Transformation(),
-            over=True,  # Placing the watermark under usually doesn't work
-            expand=True,
+    watermark_form = DecodedStreamObject()
+    watermark_form.set_data(watermark_page.get_contents().get_data())
+    watermark_form = watermark_form.flate_encode()
+    watermark_form.update(
+        {
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Form"),
+            NameObject("/BBox"): ArrayObject(watermark_page.mediabox),
+            NameObject("/Resources"): watermark_page.get(
+                "/Resources", DictionaryObject()
+            ).clone(writer),
+        }
+    )
+
+    def add_content(data):
+        content = DecodedStreamObject()
+        content.set_data(data)
+        return writer._add_object(content)
+
+    return {
+        "xobject": writer._add_object(watermark_form),
+        # Isolate the graphics state of the page from the one of the watermark
+        "before": add_content(b"q\n"),
+        "after": add_content(f"\nQ q {WATERMARK_XOBJECT_NAME} Do Q\n".encode()),
+    }
+
+
+def stamp_page(content_page, watermark):
+    from pypdf.generic import ArrayObject, DictionaryObject, NameObject
+
+    # Placing the watermark "under" usually doesn't work as the slide, typically,
+    # has a background image and as a result the watermark is never shown.
+    # If you want a watermark-like behavior then add transparency
+    # to your "stamp" PDF.
+    resources = content_page.setdefault(
+        NameObject("/Resources"), DictionaryObject()
+    ).get_object()
+    xobjects = resources.setdefault(
+        NameObject("/XObject"), DictionaryObject()
+    ).get_object()
+    xobjects[NameObject(WATERMARK_XOBJECT_NAME)] = watermark["xobject"]
+
+    contents = content_page.get("/Contents")
+    if contents is None:
+        contents = []
+    elif isinstance(contents.get_object(), ArrayObject):
+        contents = list(contents.get_object())
+    else:
+        contents = [contents]
+    content_page[NameObject("/Contents")] = ArrayObject(
+        [watermark["before"], *contents, watermark["after"]]
+    )
+
+
+@profiled
+def deduplicate_objects(writer):
+    from pypdf.generic import NullObject
+
+    # Every lecture brings its own copy of the fonts, images and theme of marp,
+    # so identical objects are replaced by references to the first one of them.
+    # Objects are identified by a hash of their content, including the numbers of
+    # the objects they refer to. Thus, e.g. identical fonts are found in one pass
+    # and the font descriptors that referred to different copies of them in the next
+    duplicates = {}  # Object number -> the number of the identical object kept
+    saved_bytes = 0
+    while True:
+        kept_objects = {}
+        new_duplicates = {}
+        for idnum, pdf_object in enumerate(writer._objects, 1):
+            if idnum in duplicates or not is_shareable(pdf_object):
+                continue
+            digest, size = hash_pdf_object(pdf_object)
+            if digest in kept_objects:
+                new_duplicates[idnum] = kept_objects[digest]
+                saved_bytes += size
+            else:
+                kept_objects[digest] = idnum
+        if not new_duplicates:
+            break
+
+        duplicates.update(new_duplicates)
+        for pdf_object in writer._objects:
+            replace_references(pdf_object, new_duplicates)
+        for idnum in new_duplicates:
+            # Keep the object numbers, the duplicates are unreachable anyway
+            writer._objects[idnum - 1] = NullObject()
+
+    return len(duplicates), saved_bytes
+
+
+def print_deduplication(duplicates, saved_bytes):
+    print(
+        f"Removed {duplicates} duplicate resources from the course slides, "
+        + f"saving {saved_bytes / 1024 / 1024:.1f} MB"
+    )
+
+
+def is_shareable(pdf_object):
+    from pypdf.generic import ArrayObject, DictionaryObject
+
+    # Pages and the document structure around them are never shared
+    if isinstance(pdf_object, DictionaryObject):
+        return (
+            pdf_object.get("/Type") not in SHARED_OBJECTS_EXCLUDED_TYPES
+            and "/Parent" not in pdf_object
+        )
+    return isinstance(pdf_object, ArrayObject)
+
+
+def hash_pdf_object(pdf_object):
+    from pypdf.generic import DictionaryObject, StreamObject
+
+    serialized = io.BytesIO()
+    if isinstance(pdf_object, StreamObject):
+        DictionaryObject.write_to_stream(pdf_object, serialized, None)
+    else:
+        pdf_object.write_to_stream(serialized, None)
+    pdf_hash = hashlib.sha256(serialized.getvalue())
+    size = serialized.tell()
+    if isinstance(pdf_object, StreamObject):
+        pdf_hash.update(b"stream")
+        pdf_hash.update(pdf_object._data)
+        size += len(pdf_object._data)
+    return pdf_hash.digest(), size
+
+
+def replace_references(pdf_object, replacements):
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+
+    pending = [pdf_object]
+    while pending:
+        pdf_object = pending.pop()
+        if isinstance(pdf_object, DictionaryObject):
+            values = pdf_object.values()
+        elif isinstance(pdf_object, ArrayObject):
+            values = pdf_object
+        else:
+            continue
+        for value in values:
+            if isinstance(value, IndirectObject):
+                value.idnum = replacements.get(value.idnum, value.idnum)
+            else:
+                pending.append(value)
+
+
+@profiled
+def recompress_streams(writer):
+    from pypdf.generic import StreamObject
+
+    for idnum, pdf_object in enumerate(writer._objects, 1):
+        if isinstance(pdf_object, StreamObject):
+            writer._objects[idnum - 1] = compress_stream(pdf_object)
+
+
+def compress_stream(stream):
+    from pypdf.generic import NameObject
+
+    if "/Filter" in stream:
+        return stream
+    compressed = stream.flate_encode()
+    if len(compressed._data) >= len(stream._data):
+        return stream
+    # pypdf keeps only the filter of the stream dictionary
+    compressed.update({key: value for key, value in stream.items() if key != "/Length"})
+    compressed[NameObject("/Filter")] = NameObject("/FlateDecode")
+    return compressed
+
+
+class StreamingPdfWriter:
+    """Writes the objects of the pages added to it to the output right away"""
+
+    def __init__(self, output_file, recompress=False):
+        self.output_file = output_file
+        self.recompress = recompress
+        self.offsets = {}
+        self.last_number = 0
+        # Identical objects are written once, like deduplicate_objects does
+        self.digests = {}
+        self.duplicates = 0
+        self.saved_bytes = 0
+        self.pages_root = self.reserve()
+        self.pages = {}
+        output_file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self):
+        self.last_number += 1
+        return self.last_number
+
+    def reference(self, number):
+        from pypdf.generic import IndirectObject
+
+        return IndirectObject(number, 0, self)
+
+    def write_object(self, pdf_object, number=None):
+        number = number or self.reserve()
+        self.offsets[number] = self.output_file.tell()
+        self.output_file.write(f"{number} 0 obj\n".encode())
+        pdf_object.write_to_stream(self.output_file, None)
+        self.output_file.write(b"\nendobj\n")
+        return number
+
+    def append_pages(self, reader):
+        from pypdf.generic import NameObject
+
+        # The objects of the reader are numbered anew as they are copied
+        copied = {}
+        in_progress = {}
+        pages_root = reader.trailer["/Root"].raw_get("/Pages")
+        copied[(pages_root.idnum, pages_root.generation)] = self.pages_root
+        # The pages of the reader are copies with the attributes they inherit and
+        # any changes made to them, e.g. stamps, so they are copied instead of
+        # the objects their references point to
+        self.pages = {}
+        for page in reader.pages:
+            page[NameObject("/Parent")] = self.reference(self.pages_root)
+            reference = page.indirect_reference
+            self.pages[(reference.idnum, reference.generation)] = page
+        return [
+            self.copy(page.indirect_reference, copied, in_progress)
+            for page in reader.pages
+        ]
+
+    def copy(self, reference, copied, in_progress):
+        key = (reference.idnum, reference.generation)
+        if key in copied:
+            return copied[key]
+        if key in in_progress:
+            # A reference cycle, e.g. a page and its annotations, so the object is
+            # numbered before its content is known
+            in_progress[key] = in_progress[key] or self.reserve()
+            return in_progress[key]
+
+        in_progress[key] = None
+        pdf_object = self.translate(
+            self.pages.get(key, reference.get_object()), copied, in_progress
+        )
+        number = in_progress.pop(key)
+        if number is None and is_shareable(pdf_object):
+            digest, size = hash_pdf_object(pdf_object)
+            if digest in self.digests:
+                number = self.digests[digest]
+                self.duplicates += 1
+                self.saved_bytes += size
+            else:
+                number = self.digests[digest] = self.write_object(pdf_object)
+        else:
+            number = self.write_object(pdf_object, number)
+        copied[key] = number
+        return number
+
+    def translate(self, pdf_object, copied, in_progress):
+        from pypdf.generic import (
+            ArrayObject,
+            DictionaryObject,
+            IndirectObject,
+            StreamObject,
         )
-        # Placing the watermark "under" usually doesn't work as the slide, typically,
-        # has a background image and as a result the watermark is never shown.
-        # If you want a watermark-like behavior then add transparency
-        # to your "stamp" PDF.
-        writer.add_page(content_page)
-
-    pdf_result = Path(content_pdf).with_suffix(".watermarked.pdf")
-    with open(pdf_result, "wb") as fp:
-        writer.write(fp)
-    pdf_result.replace(content_pdf)
+
+        if isinstance(pdf_object, IndirectObject):
+            if pdf_object.pdf is self:
+                return pdf_object
+            return self.reference(self.copy(pdf_object, copied, in_progress))
+        if isinstance(pdf_object, DictionaryObject):
+            translated = (
+                type(pdf_object)()
+                if isinstance(pdf_object, StreamObject)
+                else DictionaryObject()
+            )
+            for key, value in pdf_object.items():
+                translated[key] = self.translate(value, copied, in_progress)
+            if isinstance(pdf_object, StreamObject):
+                translated._data = pdf_object._data
+                if self.recompress:
+                    translated = compress_stream(translated)
+            return translated
+        if isinstance(pdf_object, ArrayObject):
+            return ArrayObject(
+                self.translate(value, copied, in_progress) for value in pdf_object
+            )
+        return pdf_object
+
+    def add_watermark(self, watermark_pdf):
+        from pypdf import PdfReader
+        from pypdf.generic import (
+            ArrayObject,
+            DecodedStreamObject,
+            DictionaryObject,
+            NameObject,
+        )
+
+        # Like add_watermark_xobject, but the objects are written right away
+        watermark_reader = PdfReader(watermark_pdf)
+        watermark_page = watermark_reader.pages[0]
+        watermark_form = DecodedStreamObject()
+        watermark_form.set_data(watermark_page.get_contents().get_data())
+        watermark_form = watermark_form.flate_encode()
+        watermark_form.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject(watermark_page.mediabox),
+                NameObject("/Resources"): self.translate(
+                    watermark_page.get("/Resources", DictionaryObject()), {}, {}
+                ),
+            }
+        )
+
+        def add_content(data):
+            content = DecodedStreamObject()
+            content.set_data(data)
+            return self.reference(self.write_object(content))
+
+        return {
+            "xobject": self.reference(self.write_object(watermark_form)),
+            "before": add_content(b"q\n"),
+            "after": add_content(f"\nQ q {WATERMARK_XOBJECT_NAME} Do Q\n".encode()),
+        }
+
+    def add_link(self, rect, target_page):
+        from pypdf.generic import (
+            ArrayObject,
+            DictionaryObject,
+            FloatObject,
+            NameObject,
+            NumberObject,
+        )
+
+        link = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Annot"),
+                NameObject("/Subtype"): NameObject("/Link"),
+                NameObject("/Rect"): ArrayObject(map(FloatObject, rect)),
+                NameObject("/Border"): ArrayObject([NumberObject(0)] * 3),
+                NameObject("/Dest"): ArrayObject(
+                    [self.reference(target_page), NameObject("/Fit")]
+                ),
+            }
+        )
+        return self.reference(self.write_object(link))
+
+    def add_outline(self, items, parent):
+        from pypdf.generic import (
+            ArrayObject,
+            DictionaryObject,
+            NameObject,
+            NumberObject,
+            TextStringObject,
+        )
+
+        # The items are (title, page, children) and open, like pypdf adds them
+        numbers = [self.reserve() for _ in items]
+        count = 0
+        for i, (title, page, children) in enumerate(items):
+            item = DictionaryObject(
+                {
+                    NameObject("/Title"): TextStringObject(title),
+                    NameObject("/Parent"): self.reference(parent),
+                    NameObject("/Dest"): ArrayObject(
+                        [self.reference(page), NameObject("/Fit")]
+                    ),
+                }
+            )
+            if i > 0:
+                item[NameObject("/Prev")] = self.reference(numbers[i - 1])
+            if i < len(items) - 1:
+                item[NameObject("/Next")] = self.reference(numbers[i + 1])
+            if children:
+                first, last, children_count = self.add_outline(children, numbers[i])
+                item[NameObject("/First")] = self.reference(first)
+                item[NameObject("/Last")] = self.reference(last)
+                item[NameObject("/Count")] = NumberObject(children_count)
+                count += children_count
+            self.write_object(item, numbers[i])
+            count += 1
+        return numbers[0], numbers[-1], count
+
+    def finish(self, pages, outline):
+        from pypdf.generic import (
+            ArrayObject,
+            DictionaryObject,
+            NameObject,
+            NumberObject,
+        )
+
+        self.write_object(
+            DictionaryObject(
+                {
+                    NameObject("/Type"): NameObject("/Pages"),
+                    NameObject("/Kids"): ArrayObject(map(self.reference, pages)),
+                    NameObject("/Count"): NumberObject(len(pages)),
+                }
+            ),
+            self.pages_root,
+        )
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): self.reference(self.pages_root),
+            }
+        )
+        if outline:
+            outline_root = self.reserve()
+            first, last, count = self.add_outline(outline, outline_root)
+            self.write_object(
+                DictionaryObject(
+                    {
+                        NameObject("/Type"): NameObject("/Outlines"),
+                        NameObject("/First"): self.reference(first),
+                        NameObject("/Last"): self.reference(last),
+                        NameObject("/Count"): NumberObject(count),
+                    }
+                ),
+                outline_root,
+            )
+            catalog[NameObject("/Outlines")] = self.reference(outline_root)
+        catalog_number = self.write_object(catalog)
+
+        xref_offset = self.output_file.tell()
+        self.output_file.write(f"xref\n0 {self.last_number + 1}\n".encode())
+        self.output_file.write(b"0000000000 65535 f \n")
+        for number in range(1, self.last_number + 1):
+            self.output_file.write(f"{self.offsets[number]:010} 00000 n \n".encode())
+        self.output_file.write(
+            f"trailer\n<< /Size {self.last_number + 1} /Root {catalog_number} 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n".encode()
+        )
+
+
+@contextmanager
+def atomic_output(path):
+    # Write to a sibling file and move it in place so readers never see partial outputs
+    partial_path = path.with_name(f".{path.name}.partial")
+    try:
+        yield partial_path
+        partial_path.replace(path)
+    finally:
+        partial_path.unlink(missing_ok=True)
 
 
 def override_config(config, args):
@@ -476,57 +3079,104 @@ def to_absolute_path(path):
     return path if path.is_absolute() else Path.cwd() / path
 
 
+@profiled
 def create_toc(title, chapters_and_pages) -> Path:
-    def p(pdf, text, **kwargs):
-        """Inserts a paragraph"""
-        pdf.multi_cell(
-            w=pdf.epw,
-            h=pdf.font_size,
-            text=text,
-            new_x="LMARGIN",
-            new_y="NEXT",
-            **kwargs,
-        )
+    from fpdf import FPDF
 
+    # The page numbers of the slides are given relative to the first lecture, since
+    # the number of pages of the table of contents is only known after its layout.
+    # Every entry is a single line, so the layout is computed upfront without
+    # rendering and the pages are then rendered in one go
     pdf = FPDF(unit="pt")
-    pdf.set_font("Helvetica")
+    pdf.set_auto_page_break(False)
     pdf.add_page()
+    pdf.set_font("Helvetica", size=TOC_TITLE_FONT_SIZE)
+    title_lines = pdf.multi_cell(
+        w=pdf.epw, h=pdf.font_size, text=title, dry_run=True, output="LINES"
+    )
+
+    chapter_height = TOC_CHAPTER_FONT_SIZE * 4 / 3
+    slide_height = TOC_SLIDE_FONT_SIZE
+    chapter_spacing = TOC_SLIDE_FONT_SIZE / 3
+    toc_page = 0
+    y = 40 + len(title_lines) * TOC_TITLE_FONT_SIZE + 30
+    for chapter in chapters_and_pages:
+        # Keep the chapter title on the same page as its first slide
+        if y + chapter_height + slide_height > pdf.page_break_trigger:
+            toc_page += 1
+            y = pdf.t_margin
+        chapter["toc_page"] = toc_page
+        chapter["y"] = y
+        y += chapter_height
+        for slide in chapter["contents"]:
+            if y + slide_height > pdf.page_break_trigger:
+                toc_page += 1
+                y = pdf.t_margin
+            slide["toc_page"] = toc_page
+            # In the fpdf library, the origin is at the top left corner
+            slide["rect"] = (pdf.l_margin, y, pdf.l_margin + pdf.epw, y + slide_height)
+            y += slide_height
+        y += chapter_spacing
+    toc_pages = toc_page + 1
+
     pdf.set_y(40)
-    pdf.set_font(size=40)
-    p(pdf, title, align="C")
-    pdf.y += 30
-    pdf.set_font("Courier", size=12)
+    pdf.multi_cell(
+        w=pdf.epw,
+        h=pdf.font_size,
+        text=title,
+        align="C",
+        new_x="LMARGIN",
+        new_y="NEXT",
+    )
+    last_page_number = toc_pages
     for chapter in chapters_and_pages:
-        # Add the chapter title
-        pdf.set_font("Helvetica", size=14)
-        p(pdf, chapter["chapter_title"])
-        pdf.y += pdf.font_size / 3
-        pdf.set_font("Courier", size=12)
-        # Add the chapter contents
         for slide in chapter["contents"]:
-            rect_lower_left_x = pdf.get_x()
-            rect_lower_left_y = pdf.get_y()
-            rect_upper_right_x = pdf.epw
-            rect_upper_right_y = rect_lower_left_y + pdf.font_size
-
-            slide["rect"] = (
-                rect_lower_left_x,
-                rect_lower_left_y,
-                rect_upper_right_x,
-                rect_upper_right_y,
-            )
-            p(
-                pdf,
-                f'{slide["slide_title"]} {"." * (60 - len(slide["slide_title"]))} {slide["page_number"]}',
-                align="C",
-            )
-        pdf.y += pdf.font_size / 3
-
-    # Place output in temporary folder
-    toc_path = Path(tempfile.gettempdir(), "toc.pdf")
+            slide["page_number"] += toc_pages + 1
+            last_page_number = max(last_page_number, slide["page_number"])
+    number_width = len(str(last_page_number))
+
+    for chapter in chapters_and_pages:
+        while pdf.page <= chapter["toc_page"]:
+            pdf.add_page()
+        pdf.set_font("Helvetica", size=TOC_CHAPTER_FONT_SIZE)
+        pdf.set_xy(pdf.l_margin, chapter["y"])
+        pdf.cell(
+            w=pdf.epw,
+            h=TOC_CHAPTER_FONT_SIZE,
+            text=fit_toc_text(pdf, chapter["chapter_title"], pdf.epw),
+        )
+        pdf.set_font("Courier", size=TOC_SLIDE_FONT_SIZE)
+        for slide in chapter["contents"]:
+            while pdf.page <= slide["toc_page"]:
+                pdf.add_page()
+            page_number = f'{slide["page_number"]:>{number_width}}'
+            available_width = pdf.epw - pdf.get_string_width(f"  {page_number}")
+            slide_title = fit_toc_text(pdf, slide["slide_title"], available_width)
+            dot_leaders = "." * int(
+                (available_width - pdf.get_string_width(f"{slide_title} "))
+                / pdf.get_string_width(".")
+            )
+            pdf.set_xy(slide["rect"][0], slide["rect"][1])
+            pdf.cell(
+                w=pdf.epw,
+                h=slide_height,
+                text=f"{slide_title} {dot_leaders} {page_number}",
+            )
+
+    # Place output in temporary folder, with a unique name for concurrent builds
+    toc_file, toc_path = tempfile.mkstemp(suffix="-toc.pdf")
+    os.close(toc_file)
     pdf.output(toc_path)
 
-    return toc_path
+    return Path(toc_path)
+
+
+def fit_toc_text(pdf, text, width):
+    if pdf.get_string_width(text) <= width:
+        return text
+    while text and pdf.get_string_width(text + "...") > width:
+        text = text[:-1]
+    return text + "..."
 
 
 if __name__ == "__main__":
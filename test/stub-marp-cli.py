@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Stands in for marp-cli when testing without Node and Chromium.
+# Every slide of the Markdown input becomes a blank page of the PDF output.
+# Each invocation is appended to the file in the STUB_MARP_LOG environment variable.
+
+import os
+import re
+import sys
+
+from pathlib import Path
+from pypdf import PdfWriter
+
+SLIDE_WIDTH = 1280
+SLIDE_HEIGHT = 720
+
+
+def main(args):
+    if "--version" in args:
+        print("@marp-team/marp-cli v0.0.0 (stub)")
+        return 0
+
+    if "STUB_MARP_LOG" in os.environ:
+        with open(os.environ["STUB_MARP_LOG"], "a") as log:
+            log.write(" ".join(args) + "\n")
+
+    output = None
+    inputs = []
+    remaining_args = iter(args)
+    for arg in remaining_args:
+        if arg in ("-o", "--output"):
+            output = Path(next(remaining_args))
+        elif not arg.startswith("--"):
+            inputs.append(Path(arg))
+    output_format = "pdf" if "--pdf" in args else "html"
+    assert output is None or len(inputs) == 1, "Output needs a single input"
+
+    for markdown in inputs:
+        destination = output or markdown.with_suffix(f".{output_format}")
+        slides = [s for s in markdown.read_text().split("\n---\n") if s.strip()]
+        slides = slides or [""]  # marp renders an empty deck as a single slide
+        if output_format == "pdf":
+            writer = PdfWriter()
+            for _ in slides:
+                writer.add_blank_page(SLIDE_WIDTH, SLIDE_HEIGHT)
+            writer.write(destination)
+        else:
+            sections = "".join(f"<section>{slide}</section>" for slide in slides)
+            # Like marp, images are looked up relative to the Markdown file as given
+            images = "".join(
+                f'<img src="{image}" data-found="{Path(markdown.parent, image).exists()}">'
+                for image in re.findall(r"!\[[^\]]*\]\(([^)]+)\)", markdown.read_text())
+            )
+            destination.write_text(f"<html><body>{sections}{images}</body></html>")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
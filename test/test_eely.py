@@ -1,11 +1,50 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
 import sys
+import tracemalloc
+import yaml
+import threading
+import time
+import urllib.request
+import pytest
 from pathlib import Path
+from fpdf import FPDF
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, NameObject
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 # Add the parent folder where the SUT is located to the PYTHONPATH
 sys.path.append(str(Path(__file__).parent.parent))
 import eely
 
 
+def make_args(tmp_path, **overrides):
+    # The command line arguments of a build, without the cache by default
+    args = {
+        "config_title": None,
+        "config_output": None,
+        "config_course_slides": None,
+        "config_course_archive": None,
+        "config_watermark": None,
+        "no_cache": True,
+        "cache_dir": Path(tmp_path, "cache"),
+        "cache_size": 1,
+        "dry_run": False,
+        "jobs": 1,
+        "batch": None,
+        "watermark_lectures": False,
+        "low_memory": False,
+    }
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
 def test_create_filetree(tmp_path):
     config = {
         "title": "Company X delivery",
@@ -74,3 +113,1032 @@ def test_create_filetree(tmp_path):
                 original_lecture,
             )
             assert path_to_original_lecture == linked_lecture.readlink()
+
+
+def test_manifest_skips_unchanged_and_removes_stale_outputs(
+    tmp_path, monkeypatch, capsys
+):
+    config = {
+        "title": "Linked delivery",
+        "root": str(Path(Path(__file__).parent, "my-awesome-course", "lectures")),
+        "chapters": {
+            "Hello world": {
+                "root": "hello-world",
+                "assets": "resources",
+                "lectures": {
+                    "Hello world": "hello-world.md",
+                    "Variables": "variables.md",
+                },
+            },
+        },
+    }
+    config_path = Path(tmp_path, "config.yaml")
+    output_dir = Path(tmp_path, "output", "Linked_delivery")
+
+    def build():
+        config_path.write_text(yaml.safe_dump(config))
+        monkeypatch.setattr(sys, "argv", ["eely.py", "--link", str(config_path)])
+        eely.main()
+        return capsys.readouterr().out
+
+    assert "2 new, 0 changed, 0 unchanged" in build()
+    assert "0 new, 0 changed, 2 unchanged" in build()
+
+    config["chapters"]["Basics"] = config["chapters"].pop("Hello world")
+    assert "3 outputs removed" in build()  # Including the link to the assets
+    assert not Path(output_dir, "Hello_world").exists()
+    assert Path(output_dir, "Basics", "001-variables.md").is_symlink()
+
+    # The chapter stays, although all of its previous outputs are removed
+    config["chapters"]["Basics"] = {
+        "root": "hello-world",
+        "lectures": {"Functions": "functions.md"},
+    }
+    assert "1 new, 0 changed, 0 unchanged lectures, 3 outputs removed" in build()
+    assert Path(output_dir, "Basics", "000-functions.md").is_symlink()
+
+
+def test_manifest_keeps_the_outputs_of_other_formats(tmp_path, monkeypatch, capsys):
+    config_path = Path(tmp_path, "config.yaml")
+    config_path.write_text(
+        yaml.safe_dump(
+            {
+                "title": "Delivery",
+                "root": str(
+                    Path(Path(__file__).parent, "my-awesome-course", "lectures")
+                ),
+                "marp-cli": str(Path(Path(__file__).parent, "stub-marp-cli.py")),
+                "chapters": {
+                    "Hello world": {
+                        "root": "hello-world",
+                        "lectures": {"Hello world": "hello-world.md"},
+                    },
+                },
+            }
+        )
+    )
+    output_dir = Path(tmp_path, "output", "Delivery")
+    pdf_outputs = [
+        Path(output_dir, "Hello_world", "000-hello-world.pdf"),
+        Path(output_dir, "Delivery.pdf"),
+        Path(output_dir, "Delivery.zip"),
+        Path(output_dir, "Delivery-labs.zip"),
+    ]
+
+    def build(output_format):
+        monkeypatch.setattr(
+            sys, "argv", ["eely.py", f"--{output_format}", str(config_path)]
+        )
+        eely.main()
+        return capsys.readouterr().out
+
+    assert "1 new, 0 changed, 0 unchanged lectures, 0 outputs removed" in build("pdf")
+    assert "1 new, 0 changed, 0 unchanged lectures, 0 outputs removed" in build("html")
+    assert all(output.is_file() for output in pdf_outputs)
+    assert Path(output_dir, "Hello_world", "000-hello-world.html").is_file()
+    assert "0 new, 0 changed, 1 unchanged lectures" in build("pdf")
+
+
+def test_deliveries_render_shared_lectures_once(tmp_path, monkeypatch, capsys):
+    lectures_dir = Path(Path(__file__).parent, "my-awesome-course", "lectures")
+    marp_log = Path(tmp_path, "marp.log")
+    monkeypatch.setenv("STUB_MARP_LOG", str(marp_log))
+    config_paths = []
+    for delivery, lectures in [
+        ("company-x", ["hello-world.md", "variables.md"]),
+        ("company-y", ["hello-world.md", "functions.md"]),
+    ]:
+        # Both configurations are named config.yaml, so their paths name them
+        config_path = Path(tmp_path, delivery, "config.yaml")
+        config_path.parent.mkdir()
+        config_path.write_text(
+            yaml.safe_dump(
+                {
+                    "title": f"Delivery for {delivery}",
+                    "root": str(lectures_dir),
+                    "marp-cli": str(Path(Path(__file__).parent, "stub-marp-cli.py")),
+                    "chapters": {
+                        "Hello world": {
+                            "root": "hello-world",
+                            "assets": "resources",
+                            "lectures": {lecture: lecture for lecture in lectures},
+                        },
+                    },
+                }
+            )
+        )
+        config_paths.append(str(config_path))
+    monkeypatch.setattr(sys, "argv", ["eely.py", "--html", *config_paths, "--no-cache"])
+
+    eely.main()
+
+    output = capsys.readouterr().out
+    assert "Rendered 3 unique lectures for 2 deliveries" in output
+    assert all(f"{config_path}: 2 new" in output for config_path in config_paths)
+    assert marp_log.read_text().count("hello-world.md") == 1
+    for config_path in config_paths:
+        output_dir = Path(Path(config_path).parent, "output")
+        [hello_world] = output_dir.glob("*/Hello_world/*-hello-world.html")
+        assert "<section>" in hello_world.read_text()
+
+
+def test_deliveries_share_one_pool_of_renders(tmp_path):
+    lectures_dir = Path(Path(__file__).parent, "my-awesome-course", "lectures")
+    config_paths = []
+    for delivery, lectures in enumerate(
+        [["strings.md", "numbers.md"], ["arrays.md", "booleans.md"], ["data-types.md"]]
+    ):
+        config_path = Path(tmp_path, f"delivery-{delivery}.yaml")
+        config_path.write_text(
+            yaml.safe_dump(
+                {
+                    "title": f"Delivery {delivery}",
+                    "root": str(lectures_dir),
+                    "marp-cli": str(Path(Path(__file__).parent, "stub-marp-cli.py")),
+                    "chapters": {
+                        "Data types": {
+                            "root": "data-types",
+                            "lectures": {lecture: lecture for lecture in lectures},
+                        },
+                    },
+                }
+            )
+        )
+        config_paths.append(config_path)
+    args = make_args(tmp_path)
+    lock = threading.Lock()
+    renders = []
+    running = []
+
+    def action(slide_src, slide_dest, *_):
+        with lock:
+            running.append(slide_src)
+            renders.append(len(running))
+        time.sleep(0.05)
+        slide_dest.write_text(slide_src.read_text())
+        with lock:
+            running.remove(slide_src)
+
+    eely.build_deliveries(
+        config_paths, args, "html", action, False, eely.INDEX_DEFAULT_CSS
+    )
+
+    assert renders == [1] * 5
+
+
+@pytest.mark.parametrize("watermark_lectures", [False, True])
+def test_trace_json_records_the_stages_of_the_benchmark(
+    tmp_path, monkeypatch, watermark_lectures
+):
+    monkeypatch.syspath_prepend(Path(__file__).parent.parent / "benchmark")
+    import benchmark
+
+    config_path = benchmark.generate_course(
+        tmp_path, chapters=2, lectures=2, slides=2, extras_mb=0.01, watermark=True
+    )
+    trace_path = Path(tmp_path, "trace.json")
+    monkeypatch.setattr(eely, "BUILD_PROFILE", None)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "eely.py",
+            "--pdf",
+            str(config_path),
+            "--no-cache",
+            *(["--watermark-lectures"] if watermark_lectures else []),
+            "--profile",
+            "--trace-json",
+            str(trace_path),
+        ],
+    )
+
+    eely.main()
+
+    trace = json.loads(trace_path.read_text())
+    assert all(
+        event["ph"] == "X" and event["dur"] >= 0 and event["ts"] >= 0
+        for event in trace["traceEvents"]
+    )
+    names = {event["name"] for event in trace["traceEvents"]}
+    # The others are only recorded with --low-memory and a linearized course
+    assert set(benchmark.STAGES) - names == {
+        "stream_course_slides",
+        "linearize_pdf",
+        *([] if watermark_lectures else ["add_watermark"]),
+    }
+    lectures = [e for e in trace["traceEvents"] if e["cat"] == "lecture"]
+    assert len(lectures) == 4
+
+
+def test_link_mode_skips_correct_links_and_pdf_backends(tmp_path):
+    config = {
+        "title": "Linked delivery",
+        "root": str(Path(Path(__file__).parent, "my-awesome-course", "lectures")),
+        "output": str(Path(tmp_path, "output")),
+        "chapters": {
+            "Hello world": {
+                "root": "hello-world",
+                "lectures": {"Hello world": "hello-world.md"},
+            },
+        },
+    }
+    config_path = Path(tmp_path, "config.yaml")
+    config_path.write_text(yaml.safe_dump(config))
+    check_modules = (
+        "import sys, eely; eely.main(); "
+        + "print(sorted({'pypdf', 'fpdf', 'zipfile'} & sys.modules.keys()))"
+    )
+    command = [sys.executable, "-c", check_modules, "--link", str(config_path)]
+    environment = {**os.environ, "PYTHONPATH": str(Path(__file__).parent.parent)}
+    output = subprocess.check_output(command, env=environment, text=True)
+    assert output.splitlines()[-1] == "[]"
+
+    lecture_link = Path(tmp_path, "output", "Hello_world", "000-hello-world.md")
+    link_mtime = lecture_link.lstat().st_mtime_ns
+    subprocess.check_call([*command, "--no-cache"], env=environment)
+    assert lecture_link.lstat().st_mtime_ns == link_mtime
+
+
+def test_search_index_maps_terms_to_slides_and_reuses_unchanged_lectures(
+    tmp_path, capsys
+):
+    lectures_dir = Path(tmp_path, "lectures")
+    lectures_dir.mkdir()
+    Path(lectures_dir, "closures.md").write_text(
+        "---\nmarp: true\n---\n\n# Functions\n\n---\n\n"
+        + "<!-- _class: lead -->\n# Closures\n\n![Diagram](images/scope.png)\n"
+    )
+    Path(lectures_dir, "objects.md").write_text("# Objects\n\n---\n\nMore closures")
+    config = {
+        "title": "Searchable delivery",
+        "root": str(lectures_dir),
+        "output": str(Path(tmp_path, "output")),
+        "chapters": {
+            "Basics": {
+                "lectures": {"Closures": "closures.md", "Objects": "objects.md"}
+            },
+        },
+    }
+    table_of_contents, output_dir, _, lectures, _ = eely.plan_filetree(
+        config, tmp_path, "md"
+    )
+
+    def build_search_index():
+        eely.build_search_index(table_of_contents, lectures, output_dir)
+        script = Path(output_dir, eely.SEARCH_INDEX_NAME).read_text()
+        prefix = "window.EELY_SEARCH_INDEX = "
+        return json.loads(script[len(prefix) :].rstrip().rstrip(";"))
+
+    search_index = build_search_index()
+    assert search_index["terms"]["closures"] == [0, 2, 1, 2]
+    assert search_index["terms"]["functions"] == [0, 1]
+    assert not {"marp", "lead", "scope", "png"} & search_index["terms"].keys()
+    assert search_index["lectures"][1][:3] == [
+        "Basics",
+        "Objects",
+        "Basics/001-objects.md",
+    ]
+    assert "0 unchanged lectures reused" in capsys.readouterr().out
+
+    Path(lectures_dir, "objects.md").write_text("# Objects\n\n---\n\nPrototypes")
+    search_index = build_search_index()
+    assert search_index["terms"]["closures"] == [0, 2]
+    assert "prototypes" in search_index["terms"]
+    assert "1 unchanged lectures reused" in capsys.readouterr().out
+
+
+def test_slide_terms_follow_fenced_code_and_heading_dividers():
+    markdown = (
+        "---\nmarp: true\nheadingDivider: 2\n---\n\n# Config\n\nIntro\n\n"
+        + "## YAML\n\n```yaml\n---\nkey: value\n```\n\n### Details\n\n"
+        + "---\n\n## Summary\n"
+    )
+    assert eely.extract_slide_terms(markdown) == [
+        ["config", "intro"],
+        ["details", "key", "value", "yaml"],
+        ["summary"],
+    ]
+
+    # Comments override the front matter, a list splits at those levels only
+    markdown = (
+        "<!-- headingDivider: [2] -->\n# Title\n## First\n"
+        + "~~~~\n## Code\n~~~\n~~~~\n## Second\n"
+    )
+    assert eely.extract_slide_terms(markdown) == [
+        ["title"],
+        ["code", "first"],
+        ["second"],
+    ]
+
+
+def test_render_lectures_reports_failed_lecture(tmp_path):
+    rendered = []
+
+    def action(slide_src, slide_dest, *_):
+        if slide_src.name == "broken.md":
+            raise RuntimeError("marp failed")
+        rendered.append(slide_src.name)
+
+    lectures = [
+        (Path(tmp_path, f"{name}.md"), Path(tmp_path, f"{name}.pdf"), None)
+        for name in ["first", "broken", "last"]
+    ]
+    with pytest.raises(RuntimeError, match="broken.md"):
+        eely.render_lectures(lectures, action, {}, jobs=2)
+    assert "first.md" in rendered
+
+
+def test_task_graph_runs_steps_after_their_dependencies():
+    started = threading.Event()
+    finished = []
+
+    def render():
+        # Only finishes once the independent step has started alongside it
+        assert started.wait(timeout=5)
+        finished.append("render")
+
+    def archive():
+        started.set()
+        finished.append("archive")
+
+    build_plan = eely.TaskGraph()
+    rendered = build_plan.add("Render", render)
+    build_plan.add("Archive", archive)
+    build_plan.add("Merge", lambda: finished.append("merge"), [rendered])
+    build_plan.run()
+    assert finished.index("merge") > finished.index("render")
+
+    build_plan.add("Break", lambda: 1 / 0, ["Merge"])
+    with pytest.raises(RuntimeError, match="Failed to break"):
+        build_plan.run()
+
+
+def test_render_cache_skips_unchanged_lectures(tmp_path):
+    lecture_src = Path(tmp_path, "lecture.md")
+    lecture_src.write_text("# Hello")
+    lecture_dest = Path(tmp_path, "000-lecture.pdf")
+    rendered = []
+
+    def action(slide_src, slide_dest, *_):
+        rendered.append(slide_src.read_text())
+        slide_dest.write_text(f"rendered {slide_src.read_text()}")
+
+    render_cache = eely.RenderCache(
+        Path(tmp_path, "cache"), 1024 * 1024, "no-such-marp", ["--pdf"]
+    )
+    lectures = [(lecture_src, lecture_dest, None)]
+    eely.render_lectures(lectures, action, {}, render_cache=render_cache)
+    lecture_dest.unlink()
+    eely.render_lectures(lectures, action, {}, render_cache=render_cache)
+    assert lecture_dest.read_text() == "rendered # Hello"
+    lecture_src.write_text("# Hello again")
+    eely.render_lectures(lectures, action, {}, render_cache=render_cache)
+
+    assert rendered == ["# Hello", "# Hello again"]
+    assert (render_cache.hits, render_cache.misses) == (1, 2)
+
+
+def test_rebuild_renders_lectures_again_when_their_assets_change(tmp_path, monkeypatch):
+    lectures_dir = Path(tmp_path, "lectures")
+    shutil.copytree(
+        Path(Path(__file__).parent, "my-awesome-course", "lectures", "hello-world"),
+        lectures_dir,
+    )
+    marp_log = Path(tmp_path, "marp.log")
+    monkeypatch.setenv("STUB_MARP_LOG", str(marp_log))
+    config_path = Path(tmp_path, "config.yaml")
+    config_path.write_text(
+        yaml.safe_dump(
+            {
+                "title": "Watched delivery",
+                "root": str(lectures_dir),
+                "output": str(Path(tmp_path, "output")),
+                "marp-cli": str(Path(Path(__file__).parent, "stub-marp-cli.py")),
+                "chapters": {
+                    "Hello world": {
+                        "assets": "resources",
+                        "lectures": {"Hello world": "hello-world.md"},
+                    },
+                },
+            }
+        )
+    )
+    args = make_args(tmp_path, no_cache=False)
+    delivery = eely.build_delivery(
+        config_path, args, "html", eely.create_html, False, eely.INDEX_DEFAULT_CSS
+    )
+    assert len(marp_log.read_text().splitlines()) == 1
+
+    assets_dir = Path(lectures_dir, "resources")
+    Path(assets_dir, "some-image.png").write_bytes(b"changed image")
+    eely.rebuild_delivery(
+        delivery, {("assets", assets_dir)}, args, "html", eely.create_html, False
+    )
+    assert len(marp_log.read_text().splitlines()) == 2
+
+
+def test_server_renders_lectures_when_first_requested(tmp_path, monkeypatch):
+    lectures_dir = Path(tmp_path, "lectures")
+    shutil.copytree(
+        Path(Path(__file__).parent, "my-awesome-course", "lectures", "hello-world"),
+        lectures_dir,
+    )
+    marp_log = Path(tmp_path, "marp.log")
+    monkeypatch.setenv("STUB_MARP_LOG", str(marp_log))
+    config = {
+        "title": "Served delivery",
+        "root": str(lectures_dir),
+        "output": str(Path(tmp_path, "output")),
+        "marp-cli": str(Path(Path(__file__).parent, "stub-marp-cli.py")),
+        "chapters": {
+            "Hello world": {
+                "assets": "resources",
+                "lectures": {
+                    "Hello world": "hello-world.md",
+                    "Variables": "variables.md",
+                },
+            },
+        },
+    }
+    _, output_dir, _, lectures, _ = eely.plan_filetree(config, tmp_path, "html")
+    delivery = {
+        "config": config,
+        "output_dir": output_dir,
+        "lectures": lectures,
+        "render_cache": None,
+    }
+    args = make_args(tmp_path, no_cache=False)
+    server = eely.LectureServer(("localhost", 0), delivery, args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(path):
+        url = f"http://localhost:{server.server_address[1]}/{path}"
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+
+    try:
+        lecture = "Hello_world/000-hello-world.html"
+        assert b"<section>" in request(lecture)
+        assert b"<section>" in request(lecture)
+        assert len(marp_log.read_text().splitlines()) == 1
+        assert not Path(output_dir, "Hello_world", "001-variables.html").exists()
+
+        Path(lectures_dir, "hello-world.md").write_text("# Changed")
+        assert b"# Changed" in request(lecture)
+        assert request("Hello_world/000-hello-world.pdf").startswith(b"%PDF")
+        assert len(marp_log.read_text().splitlines()) == 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batch_renders_one_marp_process_per_chapter(tmp_path, monkeypatch):
+    config_dir = Path(Path(__file__).parent, "my-awesome-course")
+    marp_log = Path(tmp_path, "marp.log")
+    monkeypatch.setenv("STUB_MARP_LOG", str(marp_log))
+    config = {
+        "title": "Batched delivery",
+        "root": "lectures",
+        "output": Path(tmp_path, "output"),
+        "marp-cli": Path(Path(__file__).parent, "stub-marp-cli.py"),
+        "chapters": {
+            "Hello world": {
+                "root": "hello-world",
+                "assets": "resources",
+                "lectures": {
+                    "Hello world": "hello-world.md",
+                    "Variables": "variables.md",
+                    "Functions": "functions.md",
+                },
+            },
+            "Data types": {
+                "root": "data-types",
+                "lectures": {
+                    "Strings": "strings.md",
+                    "Numbers": "numbers.md",
+                    "Objects": "objects/objects.md",
+                },
+            },
+        },
+    }
+
+    table_of_contents, _, _ = eely.create_filetree(
+        config, config_dir, "pdf", eely.create_pdf, batch="chapter"
+    )
+
+    assert len(marp_log.read_text().splitlines()) == len(config["chapters"])
+    for chapter_lectures in table_of_contents.values():
+        for _, lecture_path in chapter_lectures:
+            assert lecture_path.is_file()
+            assert not lecture_path.with_suffix(".md").exists()
+
+
+def test_batch_resolves_relative_paths_like_single_renders(tmp_path):
+    chapter_dir = Path(tmp_path, "lectures", "chapter")
+    for image in ["resources/logo.png", "images/photo.png"]:
+        Path(chapter_dir, image).parent.mkdir(parents=True, exist_ok=True)
+        Path(chapter_dir, image).write_bytes(b"image")
+    Path(chapter_dir, "lecture.md").write_text(
+        "# Lecture\n\n![](resources/logo.png)\n\n---\n\n![](images/photo.png)"
+    )
+    Path(chapter_dir, "other.md").write_text("# Other\n\n![](resources/logo.png)")
+
+    outputs = []
+    for batch in [None, "chapter"]:
+        config = {
+            "title": "Batched delivery",
+            "root": str(chapter_dir.parent),
+            "output": Path(tmp_path, f"output-{batch}"),
+            "marp-cli": Path(Path(__file__).parent, "stub-marp-cli.py"),
+            "chapters": {
+                "Chapter": {
+                    "root": "chapter",
+                    "assets": "resources",
+                    "lectures": {"Lecture": "lecture.md", "Other": "other.md"},
+                },
+            },
+        }
+        table_of_contents, _, _ = eely.create_filetree(
+            config, tmp_path, "html", eely.create_html, batch=batch
+        )
+        outputs.append(
+            [
+                lecture_path.read_text()
+                for _, lecture_path in table_of_contents["Chapter"]
+            ]
+        )
+
+    assert outputs[0] == outputs[1]
+    assert outputs[1][0].count('data-found="True"') == 2
+    assert not list(Path(tmp_path, "output-chapter").glob("*/*.md"))
+
+
+def test_render_nodes_take_over_from_unreachable_ones(tmp_path, monkeypatch):
+    marp_log = Path(tmp_path, "marp.log")
+    ports = []
+    for _ in range(2):
+        with socket.socket() as unused:
+            unused.bind(("localhost", 0))
+            ports.append(unused.getsockname()[1])
+    node = subprocess.Popen(
+        [
+            sys.executable,
+            Path(Path(__file__).parent.parent, "eely.py"),
+            "--render-node",
+            f"localhost:{ports[0]}",
+            "--marp-cli",
+            Path(Path(__file__).parent, "stub-marp-cli.py"),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "STUB_MARP_LOG": str(marp_log)},
+    )
+    config = {
+        "title": "Farmed delivery",
+        "root": "lectures",
+        "output": Path(tmp_path, "output"),
+        "chapters": {
+            "Hello world": {
+                "root": "hello-world",
+                "assets": "resources",
+                "lectures": {
+                    "Hello world": "hello-world.md",
+                    "Variables": "variables.md",
+                    "Functions": "functions.md",
+                },
+            },
+        },
+    }
+    try:
+        assert "listening" in node.stdout.readline()
+        # Nothing listens on the first port, so its jobs go to the second node
+        nodes = eely.RenderNodePool([("localhost", port) for port in ports[::-1]])
+        monkeypatch.setattr(eely, "RENDER_NODES", nodes)
+        table_of_contents, _, _ = eely.create_filetree(
+            config,
+            Path(Path(__file__).parent, "my-awesome-course"),
+            "pdf",
+            eely.create_pdf,
+            jobs=2,
+        )
+    finally:
+        node.terminate()
+        node.wait()
+
+    assert nodes.dead == {("localhost", ports[1])}
+    assert len(marp_log.read_text().splitlines()) == 3
+    for _, lecture_path in table_of_contents["Hello world"]:
+        assert len(PdfReader(lecture_path).pages) >= 1
+
+
+def test_render_nodes_need_no_local_marp_and_may_take_long(tmp_path, monkeypatch):
+    sockets = [socket.socket() for _ in range(2)]
+    for unused in sockets:
+        unused.bind(("localhost", 0))
+    node_port, silent_port = [unused.getsockname()[1] for unused in sockets]
+    sockets[0].close()
+    node = subprocess.Popen(
+        [
+            sys.executable,
+            Path(Path(__file__).parent.parent, "eely.py"),
+            "--render-node",
+            f"localhost:{node_port}",
+            "--marp-cli",
+            Path(Path(__file__).parent, "stub-marp-cli.py"),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    lecture_src = Path(tmp_path, "lectures", "hello-world", "hello-world.md")
+    Path(lecture_src.parent, "resources").mkdir(parents=True)
+    Path(lecture_src.parent, "resources", "logo.png").write_bytes(b"PNG")
+    lecture_src.write_text("# Hello\n\n---\n\n![logo](resources/logo.png)\n")
+    config_path = Path(tmp_path, "config.yaml")
+    config_path.write_text(
+        yaml.safe_dump(
+            {
+                "title": "Farmed delivery",
+                "root": "lectures",
+                "output": str(Path(tmp_path, "output")),
+                "marp-cli": "no-such-marp",
+                "chapters": {
+                    "Hello world": {
+                        "root": "hello-world",
+                        "assets": "resources",
+                        "lectures": {"Hello world": "hello-world.md"},
+                    },
+                },
+            }
+        )
+    )
+    args = make_args(tmp_path, no_cache=False)
+    lecture_dest = Path(tmp_path, "output", "Hello_world", "000-hello-world.html")
+    try:
+        assert "listening" in node.stdout.readline()
+        nodes = eely.RenderNodePool([("localhost", node_port)])
+        monkeypatch.setattr(eely, "RENDER_NODES", nodes)
+        eely.build_delivery(
+            config_path, args, "html", eely.create_html, False, eely.INDEX_DEFAULT_CSS
+        )
+        # The node refuses anything but the output flags, even when run with -O
+        with pytest.raises(RuntimeError, match="Unsupported flags"):
+            nodes.render(lecture_src, Path(tmp_path, "hello.html"), ["--engine"])
+    finally:
+        node.terminate()
+        node.wait()
+    assert "(stub)" in nodes.renderer()
+    assert "<section>" in lecture_dest.read_text()
+    # The chapter assets are sent along with the lecture
+    assert 'data-found="True"' in lecture_dest.read_text()
+    assert not nodes.dead
+
+    # Nothing answers on the second port, as if the render took long
+    sockets[1].listen()
+    monkeypatch.setattr(eely, "RENDER_NODE_RENDER_SECONDS", 0.1)
+    slow_nodes = eely.RenderNodePool([("localhost", silent_port)])
+    try:
+        with pytest.raises(RuntimeError, match="no answer within"):
+            slow_nodes.render(lecture_src, lecture_dest, ["--html"])
+    finally:
+        sockets[1].close()
+    assert not slow_nodes.dead
+
+
+@pytest.fixture
+def watermark_pdf(tmp_path):
+    watermark_pdf = Path(tmp_path, "watermark.pdf")
+    watermark = FPDF()
+    watermark.add_page()
+    watermark.set_font("Helvetica", size=30)
+    watermark.text(50, 50, "CONFIDENTIAL")
+    watermark.output(watermark_pdf)
+    return watermark_pdf
+
+
+def test_watermark_is_shared_by_all_pages(tmp_path, watermark_pdf):
+    content_pdf = Path(tmp_path, "content.pdf")
+    writer = PdfWriter()
+    for _ in range(50):
+        writer.add_blank_page(1280, 720)
+    writer.write(content_pdf)
+    eely.add_watermark(content_pdf, watermark_pdf)
+
+    reader = PdfReader(content_pdf)
+    watermarks = {
+        page["/Resources"]["/XObject"].raw_get(eely.WATERMARK_XOBJECT_NAME).idnum
+        for page in reader.pages
+    }
+    assert len(watermarks) == 1
+    assert all("CONFIDENTIAL" in page.extract_text() for page in reader.pages)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_lectures_are_stamped_in_processes_and_merged_with_one_watermark(
+    tmp_path, monkeypatch, watermark_pdf, jobs
+):
+    def render_blank(lecture_src, lecture_dest, *_):
+        writer = PdfWriter()
+        for _ in range(3):
+            writer.add_blank_page(1280, 720)
+        writer.write(lecture_dest)
+
+    lectures = [
+        (Path(tmp_path, f"{lecture}.md"), Path(tmp_path, f"{lecture}.pdf"), None)
+        for lecture in range(4)
+    ]
+    stamped_in_pool = []
+
+    class RecordingPool(ProcessPoolExecutor):
+        def submit(self, function, *args):
+            stamped_in_pool.append(args[0])
+            return super().submit(function, *args)
+
+    monkeypatch.setattr(eely, "ProcessPoolExecutor", RecordingPool)
+    monkeypatch.setattr(eely, "BUILD_PROFILE", eely.BuildProfile())
+    eely.render_lectures(
+        lectures, render_blank, {}, jobs=jobs, watermark_pdf=watermark_pdf
+    )
+    lecture_dests = [lecture_dest for _, lecture_dest, _ in lectures]
+    assert sorted(stamped_in_pool) == (lecture_dests if jobs > 1 else [])
+    stamps = [e for e in eely.BUILD_PROFILE.events if e["name"] == "add_watermark"]
+    assert len(stamps) == len(lectures)
+    course_slides = eely.merge_course_slides(
+        {"title": "Stamped course"},
+        {
+            "Chapter": [
+                (f"Lecture {i}", dest) for i, (_, dest, _) in enumerate(lectures)
+            ]
+        },
+        tmp_path,
+        watermark_pdf=watermark_pdf,
+        lectures_watermarked=True,
+    )
+
+    reader = PdfReader(course_slides)
+    assert len(reader.pages) == 1 + 4 * 3
+    watermarks = {
+        page["/Resources"]["/XObject"].raw_get(eely.WATERMARK_XOBJECT_NAME).idnum
+        for page in reader.pages
+    }
+    assert len(watermarks) == 1
+    assert all("CONFIDENTIAL" in page.extract_text() for page in reader.pages)
+    page_numbers = {
+        page.indirect_reference.idnum: i for i, page in enumerate(reader.pages)
+    }
+    links = [
+        page_numbers[annotation.get_object()["/Dest"][0].idnum]
+        for annotation in reader.pages[0]["/Annots"]
+    ]
+    assert links == [1, 4, 7, 10]
+    assert [item.title for item in reader.outline[1][1]] == [
+        f"Lecture {i}" for i in range(4)
+    ]
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_table_of_contents_spans_as_many_pages_as_needed(tmp_path, low_memory):
+    table_of_contents = {}
+    for chapter in range(10):
+        chapter_lectures = []
+        for lecture in range(15):
+            lecture_pdf = Path(tmp_path, f"{chapter}-{lecture}.pdf")
+            writer = PdfWriter()
+            for _ in range(lecture % 3 + 1):
+                writer.add_blank_page(1280, 720)
+            writer.write(lecture_pdf)
+            chapter_lectures.append((f"Lecture {chapter}.{lecture}", lecture_pdf))
+        table_of_contents[f"Chapter {chapter}"] = chapter_lectures
+
+    course_slides = eely.merge_course_slides(
+        {"title": "Long course"}, table_of_contents, tmp_path, low_memory=low_memory
+    )
+
+    reader = PdfReader(course_slides)
+    toc_pages = [page for page in reader.pages if page.extract_text()]
+    assert len(toc_pages) > 1
+    assert "Long course" in toc_pages[0].extract_text()
+    assert "Lecture 9.14" in toc_pages[-1].extract_text()
+    assert len(reader.pages) == len(toc_pages) + 10 * (5 * 1 + 5 * 2 + 5 * 3)
+    page_numbers = {
+        page.indirect_reference.idnum: i for i, page in enumerate(reader.pages)
+    }
+    links = [
+        page_numbers[annotation.get_object()["/Dest"][0].idnum]
+        for page in toc_pages
+        for annotation in page["/Annots"]
+    ]
+    assert len(links) == 150
+    assert links == sorted(links)
+    assert links[0] == len(toc_pages)
+
+    contents = reader.outline[1]
+    assert len(contents) == 20  # Every chapter followed by its lectures
+    assert contents[0].title == "Chapter 0"
+    assert [lecture.title for lecture in contents[1]][:2] == [
+        "Lecture 0.0",
+        "Lecture 0.1",
+    ]
+    last_lecture = contents[19][14]
+    assert reader.get_destination_page_number(last_lecture) == len(reader.pages) - 3
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_course_slides_share_identical_resources(tmp_path, low_memory):
+    logo = Path(tmp_path, "logo.png")
+    Image.frombytes("RGB", (200, 200), os.urandom(200 * 200 * 3)).save(logo)
+    table_of_contents = {"Chapter": []}
+    for lecture in range(5):
+        lecture_pdf = FPDF()
+        for _ in range(3):
+            lecture_pdf.add_page()
+            lecture_pdf.image(logo, x=10, y=10)
+            lecture_pdf.set_font("Helvetica", size=20)
+            lecture_pdf.text(10, 100, f"Lecture {lecture}")
+        lecture_pdf.output(Path(tmp_path, f"{lecture}.pdf"))
+        table_of_contents["Chapter"].append(
+            (f"Lecture {lecture}", Path(tmp_path, f"{lecture}.pdf"))
+        )
+
+    course_slides = eely.merge_course_slides(
+        {"title": "Course", "recompress_slides": True},
+        table_of_contents,
+        tmp_path,
+        low_memory=low_memory,
+    )
+
+    reader = PdfReader(course_slides)
+    assert course_slides.stat().st_size < 2 * Path(tmp_path, "0.pdf").stat().st_size
+    images = {
+        page["/Resources"]["/XObject"].raw_get(name).idnum
+        for page in reader.pages[1:]
+        for name in page["/Resources"]["/XObject"]
+    }
+    assert len(images) == 1
+    assert "Lecture 4" in reader.pages[-1].extract_text()
+
+
+def test_low_memory_merge_does_not_grow_with_the_course(tmp_path):
+    def merge_peak_memory(lectures):
+        table_of_contents = {"Chapter": lecture_pdfs[:lectures]}
+        tracemalloc.start()
+        eely.merge_course_slides(
+            {"title": "Course"}, table_of_contents, tmp_path, low_memory=True
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    # 40 lectures of 10 pages with 50 KB of unique content each
+    lecture_pdfs = []
+    for lecture in range(40):
+        writer = PdfWriter()
+        for _ in range(10):
+            page = writer.add_blank_page(1280, 720)
+            content = DecodedStreamObject()
+            content.set_data(b"% " + os.urandom(25 * 1024).hex().encode())
+            page[NameObject("/Contents")] = writer._add_object(content)
+        lecture_pdf = Path(tmp_path, f"{lecture}.pdf")
+        writer.write(lecture_pdf)
+        lecture_pdfs.append((f"Lecture {lecture}", lecture_pdf))
+
+    small_course_peak = merge_peak_memory(10)
+    large_course_peak = merge_peak_memory(40)
+    # The 30 lectures added weigh 15 MB
+    assert large_course_peak - small_course_peak < 2 * 1024 * 1024
+    assert large_course_peak < 10 * 1024 * 1024
+
+
+@pytest.mark.skipif(shutil.which("qpdf") is None, reason="qpdf is not installed")
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_course_slides_can_be_linearized(tmp_path, watermark_pdf, low_memory):
+    table_of_contents = {"Chapter": []}
+    for lecture in range(3):
+        writer = PdfWriter()
+        for _ in range(5):
+            writer.add_blank_page(1280, 720)
+        writer.write(Path(tmp_path, f"{lecture}.pdf"))
+        table_of_contents["Chapter"].append(
+            (f"Lecture {lecture}", Path(tmp_path, f"{lecture}.pdf"))
+        )
+    course_slides = eely.merge_course_slides(
+        {"title": "Course", "linearize": True},
+        table_of_contents,
+        tmp_path,
+        watermark_pdf,
+        low_memory=low_memory,
+    )
+
+    subprocess.check_call(["qpdf", "--check-linearization", course_slides])
+    reader = PdfReader(course_slides)
+    assert len(reader.pages) == 16
+    assert "CONFIDENTIAL" in reader.pages[-1].extract_text()
+
+
+def test_write_archive_compresses_in_parallel_in_order(tmp_path):
+    archive_entries = []
+    for index in range(10):
+        extra_file = Path(tmp_path, f"extra-{index}.txt")
+        extra_file.write_text(f"Exercise {index}\n" * 1000)
+        archive_entries.append((extra_file, Path("Chapter", extra_file.name)))
+    image = Path(tmp_path, "image.png")
+    image.write_bytes(b"not really compressible")
+    archive_entries.append((image, Path("Chapter", image.name)))
+    compression = eely.get_archive_compression({"compression": {"method": "deflated"}})
+    archive = Path(tmp_path, "labs.zip")
+
+    eely.write_archive(archive, archive_entries, compression, jobs=4)
+
+    with ZipFile(archive) as zip_file:
+        assert zip_file.testzip() is None
+        entries = zip_file.infolist()
+        assert [entry.filename for entry in entries] == [
+            str(arcname) for _, arcname in archive_entries
+        ]
+        assert [entry.compress_type for entry in entries] == [ZIP_DEFLATED] * 10 + [
+            ZIP_STORED
+        ]
+        assert zip_file.read("Chapter/extra-3.txt") == b"Exercise 3\n" * 1000
+
+
+@pytest.mark.parametrize("reuse", ["mtime", "crc"])
+def test_write_archive_reuses_unchanged_entries(tmp_path, reuse):
+    archive_entries = []
+    for index in range(5):
+        extra_file = Path(tmp_path, f"extra-{index}.txt")
+        extra_file.write_text(f"Exercise {index}\n" * 1000)
+        os.utime(extra_file, (1700000001, 1700000001))
+        archive_entries.append((extra_file, Path("Chapter", extra_file.name)))
+    compression = eely.get_archive_compression(
+        {"compression": {"method": "deflated", "reuse": reuse}}
+    )
+    previous_archive = Path(tmp_path, "previous.zip")
+    eely.write_archive(previous_archive, archive_entries, compression)
+
+    Path(tmp_path, "extra-2.txt").write_text("Exercise 2, corrected\n" * 1000)
+    archive = Path(tmp_path, "labs.zip")
+    reused_entries = eely.write_archive(
+        archive, archive_entries, compression, previous_archive=previous_archive
+    )
+
+    assert reused_entries == 4
+    with ZipFile(archive) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read("Chapter/extra-1.txt") == b"Exercise 1\n" * 1000
+        assert zip_file.read("Chapter/extra-2.txt") == (
+            b"Exercise 2, corrected\n" * 1000
+        )
+
+
+def test_write_archive_reuses_only_identical_entries_by_default(tmp_path):
+    answer = Path(tmp_path, "answer.py")
+    answer.write_text("answer = 41\n")
+    os.utime(answer, (1700000000, 1700000000))
+    archive_entries = [(answer, Path("Chapter", answer.name))]
+    compression = eely.get_archive_compression({"compression": {"method": "deflated"}})
+    previous_archive = Path(tmp_path, "previous.zip")
+    eely.write_archive(previous_archive, archive_entries, compression)
+
+    # Same size, and the same zip timestamp
+    answer.write_text("answer = 42\n")
+    os.utime(answer, (1700000001, 1700000001))
+    archive = Path(tmp_path, "labs.zip")
+    reused_entries = eely.write_archive(
+        archive, archive_entries, compression, previous_archive=previous_archive
+    )
+
+    assert reused_entries == 0
+    with ZipFile(archive) as zip_file:
+        assert zip_file.read("Chapter/answer.py") == b"answer = 42\n"
+
+
+def test_course_archive_adds_the_slides_to_the_labs_archive_on_every_build(
+    tmp_path,
+):
+    config = {"title": "My course", "compression": {"method": "deflated"}}
+    chapter_root = Path(tmp_path, "hello-world")
+    Path(chapter_root, "labs").mkdir(parents=True)
+    lab = Path(chapter_root, "labs", "lab.py")
+    lab.write_text("answer = 41\n")
+    extra_paths = {
+        "Hello world": {"root": chapter_root, "extras": [Path(chapter_root, "labs")]}
+    }
+    output_dir = Path(tmp_path, "output")
+    output_dir.mkdir()
+    course_slides = Path(output_dir, "My_course.pdf")
+
+    def build(slides):
+        course_slides.write_bytes(slides)
+        labs_archive = eely.zip_labs_material(config, output_dir, extra_paths)
+        course_archive = eely.zip_course_material(config, output_dir, course_slides)
+        with ZipFile(labs_archive) as labs_zip, ZipFile(course_archive) as course_zip:
+            assert labs_zip.testzip() is None and course_zip.testzip() is None
+            assert labs_zip.namelist() == ["Hello_world/labs/lab.py"]
+            assert course_zip.namelist() == [*labs_zip.namelist(), "My_course.pdf"]
+            return labs_zip.read("Hello_world/labs/lab.py"), course_zip.read(
+                "My_course.pdf"
+            )
+
+    assert build(b"%PDF first") == (b"answer = 41\n", b"%PDF first")
+    lab.write_text("answer = 42\n")
+    assert build(b"%PDF second") == (b"answer = 42\n", b"%PDF second")